@@ -1 +0,0 @@
-C:\Users\Wolff_Lab\anaconda3\envs\sleap\Scripts\sleap-convert --format analysis -o  "C:\Users\Wolff_Lab\Head_twitch\h5_result\v40-33740.mp4.h5" "C:\Users\Wolff_Lab\Head_twitch\transform_result\v40-33740.mp4.predictions.slp"
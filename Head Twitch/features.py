@@ -0,0 +1,198 @@
+import hashlib
+import json
+import shutil
+import tempfile
+import h5py
+from utils_final import *
+from manifest import file_state, unchanged
+
+# Settings which change the features of a file
+FEATURE_PARAMETERS = ["R", "Q", "nodes", "instance"]
+
+# Stored type of each feature from calculate_frame_features. Features compared
+# with the detection thresholds keep full precision, so candidates found from
+# stored features are the same as from the tracks. The rest are halved in size.
+FEATURE_TYPES = {
+    "nose_filtered": np.float32,
+    "back_filtered": np.float32,
+    "tail_filtered": np.float32,
+    "dist_body_to_earL": np.float32,
+    "dist_body_to_earR": np.float32,
+    "velocity_to_earL": np.float32,
+    "velocity_to_earR": np.float32,
+    "acceleration_to_earL": np.float32,
+    "acceleration_to_earR": np.float32,
+    "acc_sum": np.float64,
+    "angle": np.float64,
+    "dist_nose_to_line": np.float64,
+    "nan_window": bool,
+}
+
+
+# Per-frame features of analyzed files, kept so that detection, plotting and
+# statistics need not load the tracks and filter them again. The features of
+# a file are stored in folder under its name and a key of the filter settings,
+# with the size, modification time and SHA-256 of the file they came from:
+#
+#   folder/<filename>.<key>/<feature>.npy   one column file per feature
+#   folder/<filename>.<key>.npz             or all in one file, if compressed
+#   folder/<filename>.<key>.json            state of the file
+#
+# As in the manifest, stored features are used while the file's size and
+# modification time are unchanged, and the file is only hashed when they are
+# not. Features of a changed file are replaced. Column files are loaded
+# memory-mapped, reading only the frames used. Compressed files are smaller,
+# but are read whole.
+class FeatureStore:
+    def __init__(self, folder, compress=False):
+        self.folder = folder
+        self.compress = compress
+
+    def __repr__(self):
+        return f"FeatureStore at {self.folder}"
+
+    # Features of filename_path under the settings of config, or None if not
+    # stored or stored for an earlier version of the file
+    def load(self, filename_path, config):
+        path = self.path(filename_path, config)
+        try:
+            with open(path + ".json") as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return None
+        mtime_ns = state["mtime_ns"]
+        if not unchanged(state, filename_path):
+            return None
+        if state["mtime_ns"] != mtime_ns:
+            # Touched but unchanged, so the next load need not hash it again
+            write_json(path + ".json", state)
+
+        if os.path.isdir(path):
+            return {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in FEATURE_TYPES}
+        if os.path.exists(path + ".npz"):
+            with np.load(path + ".npz") as stored:
+                return {name: stored[name] for name in FEATURE_TYPES}
+        return None
+
+    # Store the features of filename_path under the settings of config,
+    # replacing those of an earlier version of the file
+    def save(self, filename_path, config, features):
+        path = self.path(filename_path, config)
+        os.makedirs(self.folder, exist_ok=True)
+        state = file_state(filename_path)
+        columns = {name: np.asarray(features[name], dtype=dtype) for name, dtype in FEATURE_TYPES.items()}
+
+        # The features are written beside the store and moved in once complete,
+        # and the state last, so a partly replaced entry is never loaded
+        if os.path.exists(path + ".json"):
+            os.remove(path + ".json")
+        if self.compress:
+            handle, temp_path = tempfile.mkstemp(dir=self.folder, suffix=".npz")
+            with os.fdopen(handle, "wb") as feature_file:
+                np.savez_compressed(feature_file, **columns)
+            os.replace(temp_path, path + ".npz")
+        else:
+            temp_path = tempfile.mkdtemp(dir=self.folder)
+            for name, column in columns.items():
+                np.save(os.path.join(temp_path, f"{name}.npy"), column)
+            if os.path.isdir(path):
+                old_path = tempfile.mkdtemp(dir=self.folder)
+                os.replace(path, os.path.join(old_path, "features"))
+                shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(temp_path, path)
+        write_json(path + ".json", state)
+        return path
+
+    # Path of the features of filename_path, without the .npz of compressed files
+    def path(self, filename_path, config):
+        return os.path.join(self.folder, f"{os.path.basename(filename_path)}.{feature_key(config)}")
+
+    # Features of every stored file, keyed by the name of the file they were
+    # computed from. Files stored under several keys give their latest features.
+    def load_all(self):
+        stored = {}
+        names = [name for name in os.listdir(self.folder) if name.endswith(".json")]
+        for name in sorted(names, key=lambda name: os.path.getmtime(os.path.join(self.folder, name))):
+            path = os.path.join(self.folder, name[:-len(".json")])
+            filename = name[:-len(".json")].rsplit(".", 1)[0]
+            if os.path.isdir(path):
+                stored[filename] = {column: np.load(os.path.join(path, f"{column}.npy"), mmap_mode="r")
+                                    for column in FEATURE_TYPES}
+            elif os.path.exists(path + ".npz"):
+                with np.load(path + ".npz") as columns:
+                    stored[filename] = {column: columns[column] for column in FEATURE_TYPES}
+        return stored
+
+
+# Key identifying the settings of config which change the features of a file
+def feature_key(config):
+    key = {name: config[name] for name in FEATURE_PARAMETERS}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+# Write data as JSON, replacing path only once the file is complete
+def write_json(path, data):
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(handle, "w") as json_file:
+        json.dump(data, json_file)
+    os.replace(temp_path, path)
+
+
+# Per-frame features of one HDF5 or SLEAP predictions file, loaded and
+# filtered with the nodes, instance, R and Q of config
+def compute_features(filename_path, config):
+    nodes = config["nodes"]
+    with h5py.File(filename_path, "r") as f:
+        locations = load_tracks(f, list(nodes.values()), config["instance"])
+    return calculate_frame_features(*(locations[nodes[part]] for part in ("nose", "earL", "earR", "back", "tail")),
+                                    config["R"], config["Q"])
+
+
+# Per-frame features of one file, from the store in config["feature_folder"]
+# if they are there, or computed and stored otherwise. Newly computed features
+# are returned as stored, so results do not depend on whether they were
+# stored before. Without a feature folder they are always computed.
+def load_features(filename_path, config):
+    if not config.get("feature_folder"):
+        return compute_features(filename_path, config)
+    store = FeatureStore(config["feature_folder"])
+    features = store.load(filename_path, config)
+    if features is None:
+        store.save(filename_path, config, compute_features(filename_path, config))
+        features = store.load(filename_path, config)
+    return features
+
+
+# Plot the ear accelerations of stored features with the given candidate
+# frames highlighted, as the figures of head_twitch.py
+def plot_features(features, frames, folder_name, filename, save_figure=False):
+    plot_dynamics(features["acceleration_to_earL"][2:], features["acceleration_to_earR"][2:], frames, frames,
+                  folder_name, filename, save_figure)
+
+
+# Summary statistics of each file's features, one row per file
+def feature_statistics(stored):
+    rows = []
+    for filename, features in stored.items():
+        tracked = ~np.asarray(features["nan_window"])
+        acc_sum = np.asarray(features["acc_sum"])
+        angle = np.asarray(features["angle"])
+        rows.append({
+            "Filename": filename,
+            "Frames": len(tracked),
+            "Tracked fraction": tracked.mean() if len(tracked) else np.nan,
+            "Median acc_sum": np.nanmedian(acc_sum[tracked]) if tracked.any() else np.nan,
+            "95th percentile acc_sum": np.nanpercentile(acc_sum[tracked], 95) if tracked.any() else np.nan,
+            "Median angle": np.nanmedian(angle[tracked]) if tracked.any() else np.nan,
+        })
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    from head_twitch import config
+
+    statistics = feature_statistics(FeatureStore(config["feature_folder"]).load_all())
+    print(statistics.to_string(index=False))
+    output_excel_path = os.path.join(config["feature_folder"], "feature_statistics.xlsx")
+    statistics.to_excel(output_excel_path, index=False)
+    print(f"Excel file saved to {output_excel_path}")
@@ -1,8 +1,10 @@
-import h5py
+from concurrent.futures import ProcessPoolExecutor
 from utils_final import *
+from manifest import Manifest, parameters_key
+from features import load_features
 
 # Configuration
-folder_name = "h5_result"
+folder_name = "h5_result"  # Analysis HDF5 files, or the SLEAP predictions (.slp) in transform_result
 threshold = 5.0
 threshold2 = 7.0
 save_figure = True
@@ -10,126 +12,213 @@ save_figure = True
 R = 1e-3  # Measurement noise covariance
 Q = 9e-5  # Process noise covariance
 
-output_folder = f"results/{folder_name}/{threshold}"
-os.makedirs(output_folder, exist_ok=True)
-
-# Initialize a dictionary to store the data for the Excel file
-excel_data = {}
-
-# Iterate over all files in the specified folder
-for filename in os.listdir(folder_name):
-    if filename.endswith(".h5"):
-        filename_path = os.path.join(folder_name, filename)
-        print(f"Processing file: {filename_path}")
-
-        # Load data from the HDF5 file
-        with h5py.File(filename_path, "r") as f:
-            dset_names = list(f.keys())
-            locations = f["tracks"][:].T
-            node_names = [n.decode() for n in f["node_names"][:]]
-
-        # Define indices for body parts
-        NOSE_INDEX = 0
-        EARL_INDEX = 1
-        EARR_INDEX = 2
-        BACK_INDEX = 3
-        TAIL_BASE_INDEX = 4
-
-        # Extract locations for each body part
-        nose_loc = locations[:, NOSE_INDEX, :, :]
-        earL_loc = locations[:, EARL_INDEX, :, :]
-        earR_loc = locations[:, EARR_INDEX, :, :]
-        back_loc = locations[:, BACK_INDEX, :, :]
-        tail_loc = locations[:, TAIL_BASE_INDEX, :, :]
-
-        length = len(tail_loc)
-
-                
-        # Apply Kalman filter to the data
-        nose_loc_filtered_x = kalman_filter(nose_loc[:, 0, 0], R, Q)
-        nose_loc_filtered_y = kalman_filter(nose_loc[:, 1, 0], R, Q)
-        nose_loc_filtered = np.vstack((nose_loc_filtered_x, nose_loc_filtered_y)).T.reshape(-1, 2, 1)
-
-        back_loc_filtered_x = kalman_filter(back_loc[:, 0, 0], R, Q)
-        back_loc_filtered_y = kalman_filter(back_loc[:, 1, 0], R, Q)
-        back_loc_filtered = np.vstack((back_loc_filtered_x, back_loc_filtered_y)).T.reshape(-1, 2, 1)
-
-        tail_loc_filtered_x = kalman_filter(tail_loc[:, 0, 0], R, Q)
-        tail_loc_filtered_y = kalman_filter(tail_loc[:, 1, 0], R, Q)
-        tail_loc_filtered = np.vstack((tail_loc_filtered_x, tail_loc_filtered_y)).T.reshape(-1, 2, 1)
-
-        earL_loc_filtered = earL_loc
-        earR_loc_filtered = earR_loc
-
-        # Calculate dynamics using filtered data
-        dist_body_to_earL, dist_body_to_earR, velocity_to_earL, velocity_to_earR, acceleration_to_earL, acceleration_to_earR = calculate_dynamics(
-            nose_loc_filtered, tail_loc_filtered, back_loc_filtered, earL_loc_filtered, earR_loc_filtered
-        )
-
-        dist, vel, acc = calculate_combined_dynamics(dist_body_to_earL, dist_body_to_earR)
-
-
-        # Sum of absolute accelerations for both ears
-        acc_sum = np.abs(acceleration_to_earR) + np.abs(acceleration_to_earL)
-        exceeding_frames_acc_sum = [i + 2 for i in range(len(acc_sum)) if abs(acc_sum[i]) > threshold2]
-        print("Acc_sum:", exceeding_frames_acc_sum)
-        
-        # Identify frames where acceleration exceeds ±7.5
-        exceeding_frames_L = [i + 2 for i in range(len(acceleration_to_earL)) if abs(acceleration_to_earL[i]) > threshold]
-        exceeding_frames_R = [i + 2 for i in range(len(acceleration_to_earR)) if abs(acceleration_to_earR[i]) > threshold]
-
-        # Filter exceeding frames to only those in exceeding_frames_acc_sum
-        exceeding_frames_L = [frame for frame in exceeding_frames_L if frame in exceeding_frames_acc_sum]
-        exceeding_frames_R = [frame for frame in exceeding_frames_R if frame in exceeding_frames_acc_sum]
-
-        # Combine and sort exceeding frames, removing duplicates
-        combined_exceeding_frames = list(set(exceeding_frames_acc_sum))
-        combined_exceeding_frames = remove_exceeding_frames_with_nan(nose_loc, combined_exceeding_frames)
-        print("Exceeding:", combined_exceeding_frames)
-        
-        # Calculate angles and filter by those below 100 degrees
-        angles = calculate_angles(nose_loc_filtered, back_loc_filtered, tail_loc_filtered)
-        angles_below_90_array, new_angles_array = calculate_angles_for_exceeding_frames(angles, combined_exceeding_frames)
-        
-
-        if new_angles_array.size == 0:
-            print(f"No angles below 90 degrees found for file: {filename}\n")
-            new_angles_array = np.empty((0, 2))
-            plot_dynamics(acceleration_to_earL, acceleration_to_earR, combined_exceeding_frames, combined_exceeding_frames, output_folder, filename, save_figure)
-            continue
-        else:
-            print("angle:", new_angles_array[:, 0])
-
-        # Calculate distances from nose to earL-earR line for exceeding frames
-        threshold_dist = 12
-        dist_nose_to_line, filtered_exceeding_frames = calculate_distances_for_exceeding_frames(
-            nose_loc_filtered, earL_loc_filtered, earR_loc_filtered, new_angles_array[:, 0], threshold_dist
-        )
-        if filtered_exceeding_frames.size == 0:
-            print(f"No angles below 90 degrees found for file: {filename}\n")
-            new_angles_array = np.empty((0, 2))
-            plot_dynamics(acceleration_to_earL, acceleration_to_earR, new_angles_array, new_angles_array, output_folder, filename, save_figure)
-            continue
-        else:
-            print("Dist:", filtered_exceeding_frames)
-
-        plot_dynamics(acceleration_to_earL, acceleration_to_earR, filtered_exceeding_frames, filtered_exceeding_frames, output_folder, filename, save_figure)
+threshold_dist = 12  # Minimum distance from nose to earL-earR line
 
-        # Add the filename and filtered exceeding frames to the Excel data dictionary
-        if filename in excel_data:
-            excel_data[filename].extend(filtered_exceeding_frames)
-        else:
-            excel_data[filename] = (filtered_exceeding_frames)
-        
+# Names of the body parts in the SLEAP skeleton
+nodes = {"nose": "nose", "earL": "earL", "earR": "earR", "back": "back", "tail": "tail_base"}
+instance = 0  # Index of the tracked animal
 
-# Prepare data for the DataFrame
-excel_rows = [[filename, ", ".join(map(str, frames))] for filename, frames in excel_data.items()]
+workers = None  # Number of files processed in parallel, None for one per CPU
+plot_workers = 2  # Number of processes rendering figures alongside the analysis
+rerun_all = False  # Analyze every file again, even if unchanged since the last run
 
-# Create a DataFrame from the Excel data list
-df = pd.DataFrame(excel_rows, columns=["Filename", "Filtered Candidates"])
-
-# Save the DataFrame to an Excel file
-output_excel_path = os.path.join(output_folder, "filtered_exceeding_frames.xlsx")
-df.to_excel(output_excel_path, index=False)
-
-print(f"Excel file saved to {output_excel_path}")
\ No newline at end of file
+output_folder = f"results/{folder_name}/{threshold}"
+feature_folder = f"results/{folder_name}/features"  # Per-frame features of each file, None to not store them
+
+config = {
+    "threshold": threshold,
+    "threshold2": threshold2,
+    "R": R,
+    "Q": Q,
+    "threshold_dist": threshold_dist,
+    "nodes": nodes,
+    "instance": instance,
+    "output_folder": output_folder,
+    "feature_folder": feature_folder,
+}
+
+
+# Find head twitch candidates in one HDF5 or SLEAP predictions file of tracked body parts.
+# Returns the sorted candidate frames, empty if there are none.
+def analyze_h5(filename_path, config):
+    filename = os.path.basename(filename_path)
+    output_folder = config["output_folder"]
+    print(f"Processing file: {filename_path}")
+
+    # Kalman filtered body parts, ear dynamics, angles and distances of every
+    # frame, from the feature store if this file was analyzed with the same
+    # filter settings before
+    features = load_features(filename_path, config)
+
+    # Accelerations start at the third frame
+    acceleration_to_earL = features["acceleration_to_earL"][2:]
+    acceleration_to_earR = features["acceleration_to_earR"][2:]
+
+    # Frame mask of acc_sum threshold crossings, False for the first two frames
+    acc_sum_mask = features["acc_sum"] > config["threshold2"]
+    print("Acc_sum:", np.flatnonzero(acc_sum_mask).tolist())
+
+    # Exclude frames with NaN values in or next to them
+    combined_exceeding_frames = np.flatnonzero(acc_sum_mask & ~features["nan_window"])
+    print("Exceeding:", combined_exceeding_frames)
+
+    # Angles of the candidate frames, filtered by those below 100 degrees
+    angles = features["angle"][combined_exceeding_frames]
+    angle_mask = angles >= 100  # False for NaN angles
+    new_angles_array = np.column_stack((combined_exceeding_frames[angle_mask], angles[angle_mask])).astype(int)
+
+    if new_angles_array.size == 0:
+        print(f"No angles below 90 degrees found for file: {filename}\n")
+        save_dynamics(acceleration_to_earL, acceleration_to_earR, combined_exceeding_frames, combined_exceeding_frames, output_folder, filename, parameters_key(config))
+        return np.array([], dtype=int)
+    else:
+        print("angle:", new_angles_array[:, 0])
+
+    # Filter by distance from nose to earL-earR line
+    frames = new_angles_array[:, 0]
+    filtered_exceeding_frames = np.sort(frames[features["dist_nose_to_line"][frames] >= config["threshold_dist"]])
+    if filtered_exceeding_frames.size == 0:
+        print(f"No angles below 90 degrees found for file: {filename}\n")
+        new_angles_array = np.empty((0, 2))
+        save_dynamics(acceleration_to_earL, acceleration_to_earR, new_angles_array, new_angles_array, output_folder, filename, parameters_key(config))
+        return filtered_exceeding_frames
+    else:
+        print("Dist:", filtered_exceeding_frames)
+
+    # Figures are rendered from the saved accelerations, see render_figures
+    save_dynamics(acceleration_to_earL, acceleration_to_earR, filtered_exceeding_frames, filtered_exceeding_frames, output_folder, filename, parameters_key(config))
+
+    return filtered_exceeding_frames
+
+
+# Analyze every HDF5 and SLEAP predictions file in folder_name on a pool of worker processes.
+# Returns the candidate frames of each file, in filename order, and the errors
+# of files which could not be analyzed. If a plot_executor is given, the figure
+# of each analyzed file is submitted to it as soon as the file is done.
+# With a manifest, files already analyzed with the same parameters are not
+# analyzed again, and their candidates are taken from the manifest, see cached_candidates.
+def analyze_folder(folder_name, config, workers=None, plot_executor=None, manifest=None):
+    filenames = sorted(filename for filename in os.listdir(folder_name) if filename.endswith((".h5", ".slp")))
+    filename_paths = {filename: os.path.join(folder_name, filename) for filename in filenames}
+    os.makedirs(config["output_folder"], exist_ok=True)
+
+    candidates, errors = {}, {}
+    if manifest is not None:
+        for filename, filename_path in filename_paths.items():
+            cached = cached_candidates(manifest, filename_path, config, plot_executor)
+            if cached is not None:
+                candidates[filename] = cached
+        if candidates:
+            print(f"Skipping {len(candidates)} files analyzed before with the same parameters")
+
+    # Files still to analyze, with each result recorded as soon as it arrives
+    pending = [filename for filename in filenames if filename not in candidates]
+    for filename, result in analyze_files([filename_paths[filename] for filename in pending], config, workers):
+        if isinstance(result, Exception):
+            errors[filename] = result
+            continue
+        candidates[filename] = result
+        submit_figure(plot_executor, config, filename)
+        if manifest is not None:
+            manifest.put(filename_paths[filename], config, result)
+            manifest.save()
+
+    for filename, error in errors.items():
+        print(f"Failed to analyze {filename}: {type(error).__name__}: {error}")
+
+    return {filename: candidates[filename] for filename in filenames if filename in candidates}, errors
+
+
+# Candidates of filename_path recorded in the manifest under the parameters of
+# config, or None if the file has to be analyzed. The sidecar and figure of a
+# file are named after the file only, so a file whose sidecar was saved with
+# other parameters is analyzed again to save it anew, and its figure of those
+# parameters is removed. A missing figure is rendered again.
+def cached_candidates(manifest, filename_path, config, plot_executor=None):
+    filename = os.path.basename(filename_path)
+    sidecar_path = os.path.join(config["output_folder"], f"{filename}_dynamics.npz")
+    figure_path = os.path.join(config["output_folder"], f"{filename}_plot.png")
+    if saved_parameters(sidecar_path) != parameters_key(config):
+        if os.path.exists(figure_path):
+            os.remove(figure_path)
+        return None
+    cached = manifest.get(filename_path, config)
+    if cached is None:
+        return None
+    if not os.path.exists(figure_path):
+        submit_figure(plot_executor, config, filename)
+    return np.array(cached, dtype=int)
+
+
+# Run analyze_h5 on each file, yielding the filename and its candidates, or the
+# exception it raised, in the order of filename_paths
+def analyze_files(filename_paths, config, workers=None):
+    if workers == 1:
+        # Run in this process, which is easier to debug
+        for filename_path in filename_paths:
+            try:
+                yield os.path.basename(filename_path), analyze_h5(filename_path, config)
+            except Exception as error:
+                yield os.path.basename(filename_path), error
+    elif filename_paths:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(analyze_h5, filename_path, config) for filename_path in filename_paths]
+            # One corrupt file only loses its own results
+            for filename_path, future in zip(filename_paths, futures):
+                try:
+                    yield os.path.basename(filename_path), future.result()
+                except Exception as error:
+                    yield os.path.basename(filename_path), error
+
+
+# Render the figure of an analyzed file in the background
+def submit_figure(plot_executor, config, filename):
+    if plot_executor is not None:
+        sidecar_path = os.path.join(config["output_folder"], f"{filename}_dynamics.npz")
+        plot_executor.submit(plot_dynamics_file, sidecar_path).add_done_callback(report_figure_error)
+
+
+def report_figure_error(future):
+    if future.exception() is not None:
+        print(f"Failed to render figure: {type(future.exception()).__name__}: {future.exception()}")
+
+
+# Render the figures of every analyzed file in output_folder, for when the
+# analysis ran without save_figure
+def render_figures(output_folder, workers=None):
+    sidecar_paths = sorted(os.path.join(output_folder, name) for name in os.listdir(output_folder) if name.endswith("_dynamics.npz"))
+    with ProcessPoolExecutor(max_workers=workers, initializer=use_agg_backend) as plot_executor:
+        return list(plot_executor.map(plot_dynamics_file, sidecar_paths))
+
+
+# Save the candidate frames of each file with candidates to an Excel file
+def save_candidates(candidates, output_folder):
+    # Prepare data for the DataFrame
+    excel_rows = [[filename, ", ".join(map(str, frames))] for filename, frames in candidates.items() if len(frames)]
+
+    # Create a DataFrame from the Excel data list
+    df = pd.DataFrame(excel_rows, columns=["Filename", "Filtered Candidates"])
+
+    # Save the DataFrame to an Excel file
+    output_excel_path = os.path.join(output_folder, "filtered_exceeding_frames.xlsx")
+    df.to_excel(output_excel_path, index=False)
+    return output_excel_path
+
+
+if __name__ == "__main__":
+    # Figures are rendered by their own processes while later files are analyzed
+    plot_executor = ProcessPoolExecutor(max_workers=plot_workers, initializer=use_agg_backend) if save_figure else None
+
+    # Candidates of earlier runs are kept in the manifest, and the Excel file is
+    # rebuilt from them and those of new or changed files
+    manifest = Manifest(os.path.join(output_folder, "manifest.json"))
+    if rerun_all:
+        manifest.files = {}
+
+    candidates, errors = analyze_folder(folder_name, config, workers, plot_executor, manifest)
+    output_excel_path = save_candidates(candidates, output_folder)
+    print(f"Excel file saved to {output_excel_path}")
+
+    if plot_executor is not None:
+        plot_executor.shutdown()
+        print(f"Figures saved to {output_folder}")
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import tempfile
+
+# Settings which change the candidates found in a file
+PARAMETERS = ["threshold", "threshold2", "R", "Q", "threshold_dist", "nodes", "instance"]
+
+
+# Record of the analyzed input files and their candidates, so reruns only analyze
+# files which are new or changed, or have not been analyzed with the current
+# parameters. Stored as JSON:
+#
+#   {"files": {filename: {"size": ..., "mtime_ns": ..., "sha256": ...,
+#                         "results": {parameters: [candidate frames]}}}}
+#
+# A file whose size and modification time are unchanged is assumed unchanged.
+# Otherwise its contents are hashed, so a copied or touched file keeps its results.
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                self.files = json.load(manifest_file)["files"]
+
+    def __repr__(self):
+        return f"Manifest of {len(self.files)} files at {self.path}"
+
+    # Candidates of filename_path under the parameters of config, or None if
+    # the file has to be analyzed
+    def get(self, filename_path, config):
+        entry = self.files.get(os.path.basename(filename_path))
+        if entry is None or not self._unchanged(entry, filename_path):
+            return None
+        return entry["results"].get(parameters_key(config))
+
+    # Record the candidates of filename_path under the parameters of config
+    def put(self, filename_path, config, candidates):
+        filename = os.path.basename(filename_path)
+        entry = self.files.get(filename)
+        if entry is None or not self._unchanged(entry, filename_path):
+            entry = dict(file_state(filename_path), results={})
+            self.files[filename] = entry
+        entry["results"][parameters_key(config)] = [int(frame) for frame in candidates]
+
+    # Write the manifest, replacing the previous one only once it is complete
+    def save(self):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        with os.fdopen(handle, "w") as manifest_file:
+            json.dump({"files": self.files}, manifest_file, indent=1)
+        os.replace(temp_path, self.path)
+
+    def _unchanged(self, entry, filename_path):
+        return unchanged(entry, filename_path)
+
+
+# Size, modification time and SHA-256 of a file, as recorded by the manifest
+def file_state(filename_path):
+    stat = os.stat(filename_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash(filename_path)}
+
+
+# Whether filename_path still has the recorded state. A file whose size and
+# modification time are unchanged is assumed unchanged, otherwise its contents
+# are hashed. The modification time of a touched but unchanged file is updated.
+def unchanged(state, filename_path):
+    stat = os.stat(filename_path)
+    if stat.st_size == state["size"] and stat.st_mtime_ns == state["mtime_ns"]:
+        return True
+    if stat.st_size != state["size"] or file_hash(filename_path) != state["sha256"]:
+        return False
+    state["mtime_ns"] = stat.st_mtime_ns
+    return True
+
+
+# SHA-256 of the contents of a file
+def file_hash(filename_path):
+    digest = hashlib.sha256()
+    with open(filename_path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Key identifying the parameters of config which change the candidates
+def parameters_key(config):
+    return json.dumps({name: config[name] for name in PARAMETERS}, sort_keys=True)
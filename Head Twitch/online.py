@@ -0,0 +1,180 @@
+import json
+import math
+import socket
+from collections import namedtuple
+from utils_final import *
+
+# A head twitch candidate, with the measures that made it one
+HeadTwitchEvent = namedtuple("HeadTwitchEvent", ["frame", "acc_sum", "angle", "distance"])
+
+
+# Head twitch detector for a live pose stream, fed one frame of keypoints at a
+# time. Runs the same Kalman filter, ear distance, acceleration, angle and
+# nose-to-ear-line checks as analyze_h5 in head_twitch.py, with the same
+# config, and finds the same candidates.
+#
+# Each frame costs a fixed amount of work. A frame is decided when the next
+# frame arrives, as a candidate must not be next to a frame with NaN values.
+# Frames are only held back at the start of a session, until each filtered
+# body part has been tracked once, as the filter starts from that location.
+# At most max_held frames are held. A body part not tracked by then starts
+# from its first tracked location when it is, so only frames before that can
+# differ from analyze_h5.
+class OnlineDetector:
+    def __init__(self, config, max_held=1000):
+        self.config = config
+        self.max_held = max_held
+        self.parts = [config["nodes"][part] for part in ("nose", "earL", "earR", "back", "tail")]
+        self.gains = kalman_gains(config["R"], config["Q"]).tolist()
+        self.frame = 0  # Index of the next frame
+
+        # Kalman estimates and number of updates of nose, back and tail x and y
+        self.estimates = None
+        self.update_counts = [0] * 6
+        self.held = []
+        self.initial = [math.nan] * 6  # First tracked values, while frames are held
+
+        # Ear distances and their velocities at the last frame
+        self.distances = None
+        self.velocities = None
+
+        # Last frame, waiting for the next frame
+        self.pending = None
+        self.previous_nan = False  # Whether the frame before the pending frame has NaN values
+
+    def __repr__(self):
+        return f"OnlineDetector after {self.frame} frames"
+
+    # Add the next frame, given as (x, y) keypoints keyed by the node names of
+    # config["nodes"]. Missing keypoints may be None or left out.
+    # Returns the events decided by this frame, usually none.
+    def update(self, keypoints):
+        values = []
+        for part in self.parts:
+            point = keypoints.get(part)
+            values.extend((math.nan, math.nan) if point is None else (float(point[0]), float(point[1])))
+        nose, earL, earR, back, tail = (values[i:i + 2] for i in range(0, 10, 2))
+        frame = (self.frame, nose + back + tail, earL + earR, math.isnan(nose[0]) or math.isnan(nose[1]))
+        self.frame += 1
+
+        if self.estimates is None:
+            self.held.append(frame)
+            self.initial = [measurement if math.isnan(initial) else initial
+                            for initial, measurement in zip(self.initial, frame[1])]
+            if any(math.isnan(initial) for initial in self.initial) and len(self.held) < self.max_held:
+                return []
+            return self._release()
+
+        return self._step(*frame)
+
+    # Decide the last frame once the stream has ended.
+    # Returns the remaining events.
+    def finish(self):
+        events = []
+        if self.held:
+            # The filter never saw some body part, analyze what there is
+            events = self._release()
+        if self.pending is not None:
+            events.extend(self._decide(next_nan=False))
+            self.pending = None
+        return events
+
+    # Start the filter from the first tracked values, NaN for body parts not
+    # yet tracked, and analyze the held frames
+    def _release(self):
+        self.estimates = self.initial
+        held, self.held = self.held, []
+        return [event for frame in held for event in self._step(*frame)]
+
+    def _step(self, frame, measurements, ears, nan_frame):
+        # Kalman filter nose, back and tail x and y. The gains are those of
+        # kalman_filter_chunk, and so is the order of operations, so the
+        # estimates are identical. The first frame only initialises the state.
+        steady = len(self.gains) - 1
+        for channel, measurement in enumerate(measurements):
+            if frame == 0 or math.isnan(measurement):
+                continue
+            count = self.update_counts[channel]
+            x = self.estimates[channel]
+            if math.isnan(x):
+                x = measurement  # First tracked after the held frames were released
+            if count < steady:
+                self.estimates[channel] = x + self.gains[count] * (measurement - x)
+            else:
+                K = self.gains[-1]
+                self.estimates[channel] = K * measurement + (1 - K) * x
+            self.update_counts[channel] = count + 1
+        nose_x, nose_y, back_x, back_y, tail_x, tail_y = self.estimates
+
+        # Perpendicular distances from the ears to the body vector, as in calculate_dynamics
+        body_x = (tail_x + back_x) / 2 - nose_x
+        body_y = (tail_y + back_y) / 2 - nose_y
+        body_length = math.sqrt(body_x * body_x + body_y * body_y)
+        distances = [abs((ear_x - nose_x) * body_y - (ear_y - nose_y) * body_x) / body_length
+                     if body_length else math.nan
+                     for ear_x, ear_y in (ears[0:2], ears[2:4])]
+
+        # Accelerations as second differences, from the third frame on
+        acc_sum = math.nan
+        if self.distances is not None:
+            velocities = [distance - previous for distance, previous in zip(distances, self.distances)]
+            if self.velocities is not None:
+                acceleration_to_earL, acceleration_to_earR = (velocity - previous for velocity, previous in zip(velocities, self.velocities))
+                acc_sum = abs(acceleration_to_earR) + abs(acceleration_to_earL)
+            self.velocities = velocities
+        self.distances = distances
+
+        # The pending frame can be decided now that this frame shows whether it has NaN values
+        events = []
+        if self.pending is not None:
+            events = self._decide(next_nan=nan_frame)
+        self.pending = (frame, acc_sum, nan_frame, [nose_x, nose_y, back_x, back_y, tail_x, tail_y] + list(ears))
+        return events
+
+    def _decide(self, next_nan):
+        frame, acc_sum, nan_frame, points = self.pending
+        previous_nan, self.previous_nan = self.previous_nan, nan_frame
+
+        # Exclude frames with NaN values in or next to them
+        if not acc_sum > self.config["threshold2"] or previous_nan or nan_frame or next_nan:
+            return []
+
+        # Filter by angle and by distance from nose to earL-earR line, using the
+        # batch functions, which are only needed for the rare candidate frames
+        nose, back, tail, earL, earR = (np.array([points[i:i + 2]]) for i in range(0, 10, 2))
+        angle = calculate_angles(nose, back, tail)[0]
+        if not angle >= 100:
+            return []
+        distance = calculate_nose_to_line_distances(nose, earL, earR)[0]
+        if not distance >= self.config["threshold_dist"]:
+            return []
+        return [HeadTwitchEvent(frame, acc_sum, float(angle), float(distance))]
+
+
+# Detect head twitches in an iterable of per-frame keypoints, such as frames
+# from a live tracker. Yields each event as soon as it is decided.
+def detect_online(keypoint_stream, config):
+    detector = OnlineDetector(config)
+    for keypoints in keypoint_stream:
+        yield from detector.update(keypoints)
+    yield from detector.finish()
+
+
+# Read per-frame keypoints from a local socket, one JSON object per line, such
+# as {"nose": [x, y], "earL": [x, y], ...} with null for untracked keypoints.
+# Stands in for a live tracker, and stops when the sender closes the connection.
+def keypoints_from_socket(host="localhost", port=5555):
+    with socket.create_connection((host, port)) as connection, connection.makefile("r") as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+if __name__ == "__main__":
+    import sys
+    from head_twitch import config
+
+    host, port = (sys.argv[1], int(sys.argv[2])) if len(sys.argv) > 2 else ("localhost", 5555)
+    for event in detect_online(keypoints_from_socket(host, port), config):
+        print(f"Head twitch candidate at frame {event.frame}: acc_sum {event.acc_sum:.2f}, "
+              f"angle {event.angle:.1f}, distance {event.distance:.1f}", flush=True)
@@ -0,0 +1,175 @@
+import os
+import queue
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from sleap_jobs import sleap_jobs, job_summary, log_job
+from head_twitch import analyze_h5, cached_candidates, save_candidates, submit_figure
+from utils_final import use_agg_backend
+
+# Marks the end of the items passed to a stage
+DONE = object()
+
+# Worker processes are spawned rather than forked, as a process forked while a
+# stage thread starts a SLEAP command keeps that command's pipes open and
+# blocks it. Spawning is also the only way on Windows.
+spawn = multiprocessing.get_context("spawn")
+
+
+# Runs each video through tracking, conversion and head twitch detection on its
+# own, so a video is analyzed as soon as it has been tracked and converted while
+# later videos are still being tracked. Without a convert command the
+# predictions are analyzed directly, and there is no conversion stage. Stages are connected by queues of at
+# most queue_size videos, so a fast stage waits for a slow one instead of
+# piling up work. Tracking and conversion are skipped for videos whose outputs
+# are up to date, as in video_to_h5.py, and detection for files already in the
+# manifest, as in head_twitch.py.
+class VideoPipeline:
+    def __init__(self, config, track_workers=1, convert_workers=1, detect_workers=None, queue_size=2,
+                 retries=2, retry_delay=5.0, manifest=None, plot_executor=None):
+        self.config = config
+        self.track_workers = track_workers
+        self.convert_workers = convert_workers
+        self.detect_workers = detect_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.manifest = manifest
+        self.plot_executor = plot_executor
+        self.jobs = []
+        self.candidates = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"VideoPipeline of {len(self.jobs)} jobs"
+
+    # Track, convert and analyze each video. Commands are as for sleap_jobs.
+    # Returns the candidate frames of each analyzed file, in filename order, and
+    # the errors of videos which could not be tracked, converted or analyzed.
+    def run(self, videos, model, output_path, h5_output_path, track_command, convert_command):
+        os.makedirs(output_path, exist_ok=True)
+        os.makedirs(h5_output_path, exist_ok=True)
+        os.makedirs(self.config["output_folder"], exist_ok=True)
+
+        to_track = queue.Queue()
+        for video in videos:
+            jobs = sleap_jobs(video, model, output_path, h5_output_path, track_command, convert_command)
+            self.jobs.extend(jobs)
+            to_track.put(jobs)
+        to_track.put(DONE)
+
+        # A queue between each two stages, the last file of each video's jobs being analyzed
+        workers = [self.track_workers] if convert_command is None else [self.track_workers, self.convert_workers]
+        queues = [to_track] + [queue.Queue(maxsize=self.queue_size) for _ in workers]
+        with ProcessPoolExecutor(max_workers=self.detect_workers, mp_context=spawn) as executor:
+            stages = [self._stage(self._run_job(index), queues[index], queues[index + 1], count)
+                      for index, count in enumerate(workers)]
+            stages.append(self._stage(lambda jobs: self._detect(executor, jobs[-1].outputs[0]), queues[-1], None, self.detect_workers))
+            for stage in stages:
+                for thread in stage:
+                    thread.join()
+
+        filenames = sorted(self.candidates)
+        return {filename: self.candidates[filename] for filename in filenames}, self.errors
+
+    # Table of the status, attempts and duration of each job
+    def summary(self):
+        return job_summary(self.jobs)
+
+    # Start workers threads taking items from inbox, passing those for which
+    # function returns True on to outbox. The last worker to finish passes on DONE.
+    def _stage(self, function, inbox, outbox, workers):
+        remaining = [workers]
+
+        def work():
+            while True:
+                item = inbox.get()
+                if item is DONE:
+                    inbox.put(DONE)  # For the other workers of this stage
+                    break
+                try:
+                    passed = function(item)
+                except Exception as error:
+                    # Keep the stage running for the other videos
+                    print(f"Pipeline error: {type(error).__name__}: {error}", flush=True)
+                    passed = False
+                if passed and outbox is not None:
+                    outbox.put(item)
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and outbox is not None:
+                outbox.put(DONE)
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    # Stage function running the tracking (0) or conversion (1) job of a video
+    def _run_job(self, index):
+        def run(jobs):
+            job = jobs[index]
+            if job.up_to_date():
+                job.status = "skipped"
+            else:
+                log_job(job, "started")
+                job.run(self.retries, self.retry_delay)
+            log_job(job, job.status)
+            if job.status == "failed":
+                with self._lock:
+                    self.errors[os.path.basename(jobs[-1].outputs[0])] = RuntimeError(f"{job.name} failed: {job.error}")
+                for later in jobs[index + 1:]:
+                    later.status = "cancelled"
+                return False
+            return True
+        return run
+
+    # Stage function finding the head twitch candidates of a converted file
+    def _detect(self, executor, filename_path):
+        filename = os.path.basename(filename_path)
+        candidates = None
+        if self.manifest is not None:
+            # The manifest records the state of files it checks, so it is shared under the lock
+            with self._lock:
+                candidates = cached_candidates(self.manifest, filename_path, self.config, self.plot_executor)
+        if candidates is None:
+            try:
+                candidates = executor.submit(analyze_h5, filename_path, self.config).result()
+            except Exception as error:
+                with self._lock:
+                    self.errors[filename] = error
+                print(f"Failed to analyze {filename}: {type(error).__name__}: {error}", flush=True)
+                return False
+            submit_figure(self.plot_executor, self.config, filename)
+            if self.manifest is not None:
+                with self._lock:
+                    self.manifest.put(filename_path, self.config, candidates)
+                    self.manifest.save()
+        with self._lock:
+            self.candidates[filename] = candidates
+        print(f"[analyzed] {filename}: {', '.join(map(str, candidates)) or 'no candidates'}", flush=True)
+        return True
+
+
+if __name__ == "__main__":
+    import video_to_h5 as sleap
+    from head_twitch import config, output_folder, save_figure, plot_workers
+    from manifest import Manifest
+
+    videos = sorted(os.path.join(sleap.video_path, f) for f in os.listdir(sleap.video_path) if f.endswith('.mp4'))
+    plot_executor = ProcessPoolExecutor(max_workers=plot_workers, mp_context=spawn, initializer=use_agg_backend) if save_figure else None
+    manifest = Manifest(os.path.join(output_folder, "manifest.json"))
+
+    pipeline = VideoPipeline(config, track_workers=sleap.max_concurrent, retries=sleap.retries,
+                             manifest=manifest, plot_executor=plot_executor)
+    candidates, errors = pipeline.run(videos, sleap.model, sleap.output_path, sleap.h5_output_path,
+                                      sleap.command, sleap.convert_command)
+    print(pipeline.summary())
+
+    output_excel_path = save_candidates(candidates, output_folder)
+    print(f"Excel file saved to {output_excel_path}")
+    if plot_executor is not None:
+        plot_executor.shutdown()
+        print(f"Figures saved to {output_folder}")
@@ -0,0 +1,182 @@
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+# A command run as a subprocess, which reads its inputs and writes its outputs.
+# The job succeeds when the command exits with 0 and every output exists.
+class Job:
+    def __init__(self, name, command, inputs, outputs, depends_on=()):
+        self.name = name
+        self.command = [str(part) for part in command]
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.depends_on = list(depends_on)
+        self.status = "pending"  # pending, running, done, skipped, failed or cancelled
+        self.attempts = 0
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    def __repr__(self):
+        return f"Job {self.name} ({self.status})"
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    # Whether every output exists and is newer than every input
+    def up_to_date(self):
+        if not all(os.path.exists(output) for output in self.outputs):
+            return False
+        newest_input = max((os.path.getmtime(path) for path in self.inputs if os.path.exists(path)), default=0)
+        return min(os.path.getmtime(output) for output in self.outputs) >= newest_input
+
+    # Run the command, trying again up to retries times if it fails
+    def run(self, retries=0, retry_delay=0):
+        self.status = "running"
+        self.started = time.time()
+        for attempt in range(retries + 1):
+            self.attempts += 1
+            try:
+                result = subprocess.run(self.command, capture_output=True, text=True)
+            except OSError as error:
+                self.error = f"{type(error).__name__}: {error}"
+            else:
+                missing = [output for output in self.outputs if not os.path.exists(output)]
+                if result.returncode == 0 and not missing:
+                    self.status = "done"
+                    self.error = None
+                    break
+                if result.returncode != 0:
+                    # The end of the output usually says what went wrong
+                    self.error = f"exit code {result.returncode}: {(result.stderr or result.stdout).strip()[-500:]}"
+                else:
+                    self.error = f"outputs not written: {missing}"
+            if attempt < retries:
+                time.sleep(retry_delay)
+        else:
+            self.status = "failed"
+        self.finished = time.time()
+        return self
+
+
+# Runs jobs as subprocesses, up to max_concurrent at a time, each once the jobs
+# it depends on are done. Jobs whose outputs are up to date are skipped, and
+# jobs depending on a failed job are cancelled.
+class JobScheduler:
+    def __init__(self, max_concurrent=2, retries=2, retry_delay=5.0, verbose=True):
+        self.max_concurrent = max_concurrent
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.verbose = verbose
+        self.jobs = []
+
+    def __repr__(self):
+        return f"JobScheduler of {len(self.jobs)} jobs, {self.max_concurrent} at a time"
+
+    def add(self, job):
+        self.jobs.append(job)
+        return job
+
+    # Run every job, returning them once all have finished
+    def run(self):
+        pending = [job for job in self.jobs if job.status == "pending"]
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            while pending or running:
+                for job in self._ready(pending, len(running)):
+                    self._log(job, "started")
+                    running[executor.submit(job.run, self.retries, self.retry_delay)] = job
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = running.pop(future)
+                    future.result()
+                    self._log(job, job.status)
+
+        # Jobs depending on jobs outside this scheduler never became ready
+        for job in pending:
+            job.status = "cancelled"
+        return self.jobs
+
+    # Table of the status, attempts and duration of each job
+    def summary(self):
+        return job_summary(self.jobs)
+
+    # Take the jobs which can start now out of pending, skipping or cancelling
+    # those which need not or cannot run
+    def _ready(self, pending, running_count):
+        ready = []
+        changed = True
+        while changed:
+            changed = False
+            for job in list(pending):
+                if any(dependency.status in ("failed", "cancelled") for dependency in job.depends_on):
+                    job.status = "cancelled"
+                elif not all(dependency.status in ("done", "skipped") for dependency in job.depends_on):
+                    continue
+                elif job.up_to_date():
+                    job.status = "skipped"
+                elif running_count + len(ready) < self.max_concurrent:
+                    ready.append(job)
+                else:
+                    continue
+                pending.remove(job)
+                if job.status != "pending":
+                    self._log(job, job.status)
+                changed = True
+        return ready
+
+    def _log(self, job, event):
+        if self.verbose:
+            log_job(job, event)
+
+
+# Table of the status, attempts and duration of each job
+def job_summary(jobs):
+    lines = [f"{'Job':<50} {'Status':<10} {'Attempts':>8} {'Seconds':>8}"]
+    for job in jobs:
+        duration = "" if job.duration is None else f"{job.duration:.1f}"
+        lines.append(f"{job.name:<50} {job.status:<10} {job.attempts:>8} {duration:>8}")
+        if job.error:
+            lines.append(f"    {job.error}")
+    return "\n".join(lines)
+
+
+# Print a job event, such as started, done or failed
+def log_job(job, event):
+    duration = "" if job.duration is None or event == "started" else f" after {job.duration:.1f} s"
+    error = f": {job.error}" if event == "failed" else ""
+    print(f"[{event}] {job.name}{duration}{error}", flush=True)
+
+
+# Jobs tracking a video with sleap-track and converting the predictions to an
+# analysis HDF5 file with sleap-convert. Commands are given as the program and
+# any leading arguments, so that a stub can stand in for SLEAP. Without a
+# convert_command only the tracking job is returned, as the predictions can be
+# analyzed directly.
+def sleap_jobs(video, model, output_path, h5_output_path, track_command, convert_command):
+    file_name = os.path.basename(video)
+    predictions = os.path.join(output_path, file_name + ".predictions.slp")
+    h5_file = os.path.join(h5_output_path, file_name + ".h5")
+
+    track = Job(f"track {file_name}",
+                as_command(track_command) + [video, "-m", model, "--tracking.tracker", "none",
+                                             "-o", predictions, "--verbosity", "json", "--no-empty-frames"],
+                inputs=[video, model], outputs=[predictions])
+    if convert_command is None:
+        return (track,)
+    convert = Job(f"convert {file_name}",
+                  as_command(convert_command) + ["--format", "analysis", "-o", h5_file, predictions],
+                  inputs=[predictions], outputs=[h5_file], depends_on=[track])
+    return track, convert
+
+
+# A command as a list of arguments, from a program path or a list
+def as_command(command):
+    return [command] if isinstance(command, str) else list(command)
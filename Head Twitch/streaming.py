@@ -0,0 +1,153 @@
+import h5py
+from utils_final import *
+
+
+# Head twitch detector fed with consecutive chunks of frames, for recordings too
+# long to hold in memory. Gives exactly the same candidates as analyze_h5 in
+# head_twitch.py, using the same config.
+#
+# Between chunks it carries the Kalman filter state, the ear distances of the
+# last two frames for the second differences, and the last frame, which is
+# only decided once the next frame shows whether it is next to a NaN value.
+# Frames are only held back at the start of a recording, until each filtered
+# body part has been tracked once, as the filter starts from that location.
+# Chunks are held until they add up to max_held frames. A body part not tracked
+# by then starts from its first tracked location when it is, as in
+# OnlineDetector, so only frames before that can differ from analyze_h5.
+class StreamingDetector:
+    def __init__(self, config, max_held=100000):
+        self.config = config
+        self.max_held = max_held
+        self.frames = 0  # Frames received
+        self.kalman_state = None
+        self.distances = np.empty((0, 2))  # Ear distances of the last two frames
+        self.held = []  # Chunks held back until the filter can start
+        self.held_frames = 0
+        self.tracked = np.zeros(6, dtype=bool)  # Whether nose, back and tail x and y were tracked in them
+
+        # Features of the last frame, waiting for the next frame
+        self.pending = None
+        self.previous_nan = False  # Whether the frame before the pending frame has NaN values
+
+    def __repr__(self):
+        return f"StreamingDetector after {self.frames} frames"
+
+    # Add the next chunk of frames, given as (frames, 2) locations keyed by the
+    # node names of config["nodes"] like load_tracks returns.
+    # Returns the candidate frames decided by this chunk.
+    def update(self, locations):
+        nodes = self.config["nodes"]
+        chunk = [np.asarray(locations[nodes[part]], dtype=float).reshape(-1, 2)
+                 for part in ("nose", "earL", "earR", "back", "tail")]
+        self.frames += len(chunk[0])
+
+        if self.kalman_state is None:
+            # Held chunks are only joined once, when the filter can start
+            self.held.append(chunk)
+            self.held_frames += len(chunk[0])
+            nose, earL, earR, back, tail = chunk
+            self.tracked |= (~np.isnan(np.hstack((nose, back, tail)))).any(axis=0)
+            if not self.tracked.all() and self.held_frames < self.max_held:
+                return np.array([], dtype=int)
+            chunk = self._release()
+
+        return self._process(*chunk)
+
+    # Decide the last frame once the recording has ended.
+    # Returns the remaining candidate frames.
+    def finish(self):
+        candidates = []
+        if self.held:
+            # The filter never saw some body part, analyze what there is
+            candidates.append(self._process(*self._release()))
+        if self.pending is not None:
+            candidates.append(self._decide(*self.pending, next_nan=np.array([False])))
+            self.pending = None
+        return np.concatenate(candidates) if candidates else np.array([], dtype=int)
+
+    # Held chunks joined into one, emptying the held chunks
+    def _release(self):
+        chunk = [np.concatenate(part) if len(part) > 1 else part[0] for part in zip(*self.held)]
+        self.held = []
+        self.held_frames = 0
+        return chunk
+
+    def _process(self, nose_loc, earL_loc, earR_loc, back_loc, tail_loc):
+        length = len(nose_loc)
+        if length == 0:
+            return np.array([], dtype=int)
+        first_frame = self.frames - length
+
+        # Apply Kalman filter to the x and y of nose, back and tail, continuing from the previous chunk
+        filtered, self.kalman_state = kalman_filter_chunk(
+            np.hstack((nose_loc, back_loc, tail_loc)), self.config["R"], self.config["Q"], self.kalman_state)
+        nose_loc_filtered = filtered[:, 0:2].reshape(-1, 2, 1)
+        back_loc_filtered = filtered[:, 2:4].reshape(-1, 2, 1)
+        tail_loc_filtered = filtered[:, 4:6].reshape(-1, 2, 1)
+
+        # Accelerations from the distances of this chunk and the last two frames before it
+        dist_body_to_earL, dist_body_to_earR = calculate_dynamics(
+            nose_loc_filtered, tail_loc_filtered, back_loc_filtered, earL_loc[:, :, np.newaxis], earR_loc[:, :, np.newaxis]
+        )[:2]
+        distances = np.concatenate((self.distances, np.column_stack((dist_body_to_earL, dist_body_to_earR))))
+        acceleration = np.diff(np.diff(distances, axis=0), axis=0)
+        self.distances = distances[-2:]
+
+        # Frames of this chunk with two frames before them in the recording have an acceleration
+        acc_sum_mask = np.zeros(length, dtype=bool)
+        acc_sum_mask[length - len(acceleration):] = np.abs(acceleration[:, 1]) + np.abs(acceleration[:, 0]) > self.config["threshold2"]
+
+        frames = np.arange(first_frame, first_frame + length)
+        nan_frames = np.isnan(nose_loc).any(axis=1)
+        points = np.hstack((filtered, earL_loc, earR_loc))
+
+        # Prepend the pending frame of the previous chunk, and keep the last frame pending
+        if self.pending is not None:
+            frames, acc_sum_mask, nan_frames, points = (
+                np.concatenate((held, new)) for held, new in zip(self.pending, (frames, acc_sum_mask, nan_frames, points)))
+        self.pending = (frames[-1:], acc_sum_mask[-1:], nan_frames[-1:], points[-1:])
+        return self._decide(frames[:-1], acc_sum_mask[:-1], nan_frames[:-1], points[:-1], next_nan=nan_frames[1:])
+
+    # Candidates among frames, given whether each frame and the frame after it have NaN values
+    def _decide(self, frames, acc_sum_mask, nan_frames, points, next_nan):
+        if len(frames) == 0:
+            return np.array([], dtype=int)
+        previous_nan = np.concatenate(([self.previous_nan], nan_frames[:-1]))
+        self.previous_nan = nan_frames[-1]
+
+        # Exclude frames with NaN values in or next to them
+        candidates = np.flatnonzero(acc_sum_mask & ~(previous_nan | nan_frames | next_nan))
+        if candidates.size == 0:
+            return np.array([], dtype=int)
+        nose_loc_filtered, back_loc_filtered, tail_loc_filtered, earL_loc, earR_loc = (
+            points[:, column:column + 2] for column in range(0, 10, 2))
+
+        # Filter by angles of at least 100 degrees
+        angles = calculate_angles(nose_loc_filtered, back_loc_filtered, tail_loc_filtered, candidates)
+        candidates = candidates[angles >= 100]
+
+        # Filter by distance from nose to earL-earR line
+        dist_nose_to_line = calculate_nose_to_line_distances(nose_loc_filtered, earL_loc, earR_loc, candidates)
+        candidates = candidates[dist_nose_to_line >= self.config["threshold_dist"]]
+
+        return frames[candidates]
+
+
+# Find head twitch candidates in one HDF5 file, reading chunk_size frames at a time.
+# Returns the sorted candidate frames, as analyze_h5 in head_twitch.py.
+def analyze_h5_streaming(filename_path, config, chunk_size=100000, max_held=100000):
+    detector = StreamingDetector(config, max_held)
+    candidates = []
+    with h5py.File(filename_path, "r") as f:
+        for start, locations in iter_track_chunks(f, list(config["nodes"].values()), chunk_size, config["instance"]):
+            candidates.append(detector.update(locations))
+    candidates.append(detector.finish())
+    return np.concatenate(candidates)
+
+
+if __name__ == "__main__":
+    import sys
+    from head_twitch import config
+
+    for filename_path in sys.argv[1:]:
+        print(f"{filename_path}: {', '.join(map(str, analyze_h5_streaming(filename_path, config)))}")
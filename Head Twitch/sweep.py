@@ -0,0 +1,80 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from utils_final import *
+from features import load_features
+
+# Values tried for each parameter. Every combination is evaluated, here 100.
+# threshold is not swept, as it only marks frames in the figures and does not
+# change the candidates.
+threshold2_values = [5.0, 6.0, 7.0, 8.0, 9.0]
+threshold_dist_values = [8, 10, 12, 14, 16]
+angle_values = [90, 100, 110, 120]  # Minimum angle between nose-back and back-tail
+
+workers = None  # Number of files processed in parallel, None for one per CPU
+
+
+# Candidate frames of every combination of threshold2, threshold_dist and angle
+# values, from the features of one file. A frame is a candidate when its
+# acc_sum exceeds threshold2, its angle and nose-to-ear-line distance are at
+# least the angle and threshold_dist, and no NaN is in or next to it, as in
+# analyze_h5. Yields each combination and its candidate frames.
+def sweep_features(features, threshold2_values, threshold_dist_values, angle_values):
+    # Only frames passing the most lenient combination can pass any other
+    possible = np.flatnonzero(~features["nan_window"]
+                              & (features["acc_sum"] > min(threshold2_values))
+                              & (features["dist_nose_to_line"] >= min(threshold_dist_values))
+                              & (features["angle"] >= min(angle_values)))
+    acc_sum, dist_nose_to_line, angle = (features[name][possible] for name in ("acc_sum", "dist_nose_to_line", "angle"))
+
+    for threshold2, threshold_dist, min_angle in itertools.product(threshold2_values, threshold_dist_values, angle_values):
+        candidates = possible[(acc_sum > threshold2) & (dist_nose_to_line >= threshold_dist) & (angle >= min_angle)]
+        yield (threshold2, threshold_dist, min_angle), candidates
+
+
+# Rows of the sweep table for one file, computing its features only once, or
+# loading them from the feature store
+def sweep_h5(filename_path, config, threshold2_values, threshold_dist_values, angle_values):
+    filename = os.path.basename(filename_path)
+    print(f"Sweeping file: {filename_path}")
+    features = load_features(filename_path, config)
+    return [[filename, threshold2, threshold_dist, min_angle, len(candidates), ", ".join(map(str, candidates))]
+            for (threshold2, threshold_dist, min_angle), candidates
+            in sweep_features(features, threshold2_values, threshold_dist_values, angle_values)]
+
+
+# Sweep every HDF5 and SLEAP predictions file in folder_name on a pool of worker
+# processes. Returns a table with one row per file and combination, and the
+# errors of files which could not be analyzed.
+def sweep_folder(folder_name, config, threshold2_values, threshold_dist_values, angle_values, workers=None):
+    filenames = sorted(filename for filename in os.listdir(folder_name) if filename.endswith((".h5", ".slp")))
+    rows, errors = [], {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {filename: executor.submit(sweep_h5, os.path.join(folder_name, filename), config,
+                                             threshold2_values, threshold_dist_values, angle_values)
+                   for filename in filenames}
+        # One corrupt file only loses its own rows
+        for filename, future in futures.items():
+            try:
+                rows.extend(future.result())
+            except Exception as error:
+                errors[filename] = error
+                print(f"Failed to sweep {filename}: {type(error).__name__}: {error}")
+
+    table = pd.DataFrame(rows, columns=["Filename", "threshold2", "threshold_dist", "angle", "Count", "Filtered Candidates"])
+    return table, errors
+
+
+if __name__ == "__main__":
+    from head_twitch import config, folder_name
+
+    table, errors = sweep_folder(folder_name, config, threshold2_values, threshold_dist_values, angle_values, workers)
+
+    # Total candidates of each combination over all files
+    totals = table.groupby(["threshold2", "threshold_dist", "angle"])["Count"].sum()
+    print(totals.to_string())
+
+    output_folder = f"results/{folder_name}"
+    os.makedirs(output_folder, exist_ok=True)
+    output_excel_path = os.path.join(output_folder, "threshold_sweep.xlsx")
+    table.to_excel(output_excel_path, index=False)
+    print(f"Excel file saved to {output_excel_path}")
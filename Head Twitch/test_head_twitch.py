@@ -0,0 +1,338 @@
+import os
+import shutil
+import h5py
+import numpy as np
+import pytest
+from head_twitch import analyze_h5, config
+from utils_final import *
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "h5_result", "v40-33740.mp4.h5")
+SAMPLE_SLP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transform_result", "v40-33740.mp4.predictions.slp")
+
+
+# Copy of the sample analysis file with a second animal, the first one moved
+# by offset, as instance 1
+@pytest.fixture
+def two_instance_file(tmp_path):
+    path = tmp_path / "two_instances.h5"
+    with h5py.File(SAMPLE, "r") as sample, h5py.File(path, "w") as f:
+        tracks = sample["tracks"][:]
+        f["tracks"] = np.concatenate((tracks, tracks + np.array([40.0, -25.0])[:, np.newaxis, np.newaxis]))
+        f["node_names"] = sample["node_names"][:]
+    return str(path)
+
+
+def test_functions_use_the_given_instance():
+    rng = np.random.default_rng(0)
+    nose, earL, earR, back, tail = (rng.normal(size=(50, 2, 2)) for _ in range(5))
+    frames = [3, 7, 20]
+
+    # Without an instance, the first, as the loops of the original code
+    np.testing.assert_array_equal(calculate_angles(nose, back, tail, frames),
+                                  calculate_angles(nose[..., 0], back[..., 0], tail[..., 0], frames))
+    for instance in (0, 1):
+        single = [loc[..., instance] for loc in (nose, earL, earR, back, tail)]
+        np.testing.assert_array_equal(as_points(nose, frames, instance), single[0][frames])
+        np.testing.assert_array_equal(calculate_angles(nose, back, tail, frames, instance=instance),
+                                      calculate_angles(single[0], single[3], single[4], frames))
+        np.testing.assert_array_equal(calculate_nose_to_line_distances(nose, earL, earR, instance=instance),
+                                      calculate_nose_to_line_distances(*single[:3]))
+        distances, filtered = calculate_distances_for_exceeding_frames(nose, earL, earR, frames, 0.5, instance=instance)
+        np.testing.assert_array_equal(filtered, calculate_distances_for_exceeding_frames(*single[:3], frames, 0.5)[1])
+
+
+@pytest.mark.parametrize("instance", [0, 1])
+def test_analyze_two_instance_file(two_instance_file, tmp_path, instance):
+    run_config = dict(config, instance=instance, output_folder=str(tmp_path / "results"), feature_folder=str(tmp_path / "features"))
+    os.makedirs(run_config["output_folder"])
+    single_config = dict(run_config, instance=0)
+    np.testing.assert_array_equal(analyze_h5(two_instance_file, run_config), analyze_h5(SAMPLE, single_config))
+    np.testing.assert_array_equal(analyze_h5(two_instance_file, run_config), [190, 191])
+
+
+# Copy of the sample predictions file without some frames, as --no-empty-frames
+# leaves out frames without instances, and with its frames table out of order
+@pytest.fixture
+def slp_without_frames(tmp_path):
+    path = tmp_path / "without_frames.slp"
+    shutil.copy(SAMPLE_SLP, path)
+    with h5py.File(path, "a") as f:
+        frames = f["frames"][:]
+        del f["frames"]
+        f["frames"] = np.delete(frames, [0, 1, 50, 51, 52, 700])[::-1]
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 64, 5000])
+def test_slp_chunks_match_analysis_file(slp_without_frames, chunk_size):
+    with h5py.File(SAMPLE, "r") as f:
+        expected = f["tracks"][:].T
+        node_names = get_node_names(f)
+    expected[[0, 1, 50, 51, 52, 700]] = np.nan
+    with h5py.File(slp_without_frames, "r") as f:
+        np.testing.assert_array_equal(read_slp_tracks(f), expected)
+        for start, locations in iter_track_chunks(f, node_names, chunk_size):
+            for index, name in enumerate(node_names):
+                np.testing.assert_array_equal(locations[name], expected[start:start + chunk_size, index, :, 0])
+
+
+def test_feature_store_hashes_only_changed_files(tmp_path, monkeypatch):
+    import manifest
+    from features import load_features
+
+    hashed = []
+    file_hash = manifest.file_hash
+    monkeypatch.setattr(manifest, "file_hash", lambda path: hashed.append(path) or file_hash(path))
+    path = tmp_path / "sample.h5"
+    shutil.copy(SAMPLE, path)
+    run_config = dict(config, feature_folder=str(tmp_path / "features"))
+
+    first = load_features(str(path), run_config)
+    assert len(hashed) == 1  # Recorded when stored
+    np.testing.assert_array_equal(load_features(str(path), run_config)["acc_sum"], first["acc_sum"])
+    assert len(hashed) == 1
+
+    # A touched file is hashed once, and its features are kept
+    os.utime(path, ns=(0, 10**18))
+    load_features(str(path), run_config)
+    load_features(str(path), run_config)
+    assert len(hashed) == 2
+    assert len(os.listdir(tmp_path / "features")) == 2
+
+    # A changed file gets new features in place of the old ones
+    with h5py.File(path, "a") as f:
+        f["tracks"][0, 0, 0, 10] += 50.0
+    changed = load_features(str(path), run_config)
+    assert not np.array_equal(changed["nose_filtered"], first["nose_filtered"])
+    assert len(os.listdir(tmp_path / "features")) == 2
+
+
+# Online detection of the sample with the tail untracked for the first 100
+# frames, holding at most max_held frames before the filter starts
+@pytest.mark.parametrize("max_held", [10, 1000])
+def test_online_detector_holds_few_frames(tmp_path, max_held):
+    from online import OnlineDetector
+
+    path = tmp_path / "late_tail.h5"
+    shutil.copy(SAMPLE, path)
+    with h5py.File(path, "a") as f:
+        tail = list(get_node_names(f)).index(config["nodes"]["tail"])
+        f["tracks"][0, :, tail, :100] = np.nan
+        locations = load_tracks(f, get_node_names(f))
+    run_config = dict(config, output_folder=str(tmp_path / "results"), feature_folder=None)
+    os.makedirs(run_config["output_folder"])
+    expected = analyze_h5(str(path), run_config)
+    assert len(expected)
+
+    detector = OnlineDetector(run_config, max_held)
+    events = []
+    for index in range(len(locations[config["nodes"]["nose"]])):
+        events.extend(detector.update({name: None if np.isnan(location[index, 0]) else location[index]
+                                       for name, location in locations.items()}))
+        assert len(detector.held) <= max_held
+    events.extend(detector.finish())
+    np.testing.assert_array_equal([event.frame for event in events], expected)
+
+
+# Rerun of a folder with the manifest after a parameter change and back, with
+# the sidecar and figure following the parameters of the latest run
+def test_manifest_reruns_keep_sidecar_current(tmp_path):
+    from concurrent.futures import Future
+    from head_twitch import analyze_folder
+    from manifest import Manifest, parameters_key
+
+    class RecordingExecutor:
+        def __init__(self):
+            self.submitted = []
+
+        def submit(self, function, sidecar_path):
+            self.submitted.append(saved_parameters(sidecar_path))
+            future = Future()
+            future.set_result(function(sidecar_path))
+            return future
+
+    folder = tmp_path / "h5"
+    folder.mkdir()
+    shutil.copy(SAMPLE, folder / "sample.h5")
+    run_config = dict(config, output_folder=str(tmp_path / "results"), feature_folder=str(tmp_path / "features"))
+    other_config = dict(run_config, threshold_dist=config["threshold_dist"] + 100)
+    sidecar_path = os.path.join(run_config["output_folder"], "sample.h5_dynamics.npz")
+    figure_path = os.path.join(run_config["output_folder"], "sample.h5_plot.png")
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    plt.switch_backend("Agg")
+
+    for run, expected in ((run_config, [190, 191]), (other_config, []), (run_config, [190, 191])):
+        executor = RecordingExecutor()
+        candidates, errors = analyze_folder(str(folder), run, 1, executor, manifest)
+        assert not errors
+        np.testing.assert_array_equal(candidates["sample.h5"], expected)
+        assert saved_parameters(sidecar_path) == parameters_key(run)
+        assert executor.submitted == [parameters_key(run)]
+        assert os.path.exists(figure_path)
+
+    # An unchanged rerun takes the candidates from the manifest and keeps the figure
+    executor = RecordingExecutor()
+    candidates, errors = analyze_folder(str(folder), run_config, 1, executor, manifest)
+    np.testing.assert_array_equal(candidates["sample.h5"], [190, 191])
+    assert executor.submitted == []
+
+    # A missing figure is rendered again from the sidecar
+    os.remove(figure_path)
+    analyze_folder(str(folder), run_config, 1, executor, manifest)
+    assert executor.submitted == [parameters_key(run_config)]
+    assert os.path.exists(figure_path)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 100000])
+def test_streaming_matches_analyze_h5(tmp_path, chunk_size):
+    from streaming import analyze_h5_streaming
+
+    run_config = dict(config, output_folder=str(tmp_path / "results"), feature_folder=None)
+    os.makedirs(run_config["output_folder"])
+    np.testing.assert_array_equal(analyze_h5_streaming(SAMPLE, run_config, chunk_size), analyze_h5(SAMPLE, run_config))
+
+
+# Streaming detection of the sample with the tail untracked for the first 100
+# frames, holding chunks of at most max_held frames before the filter starts
+@pytest.mark.parametrize("max_held", [10, 1000])
+def test_streaming_detector_holds_few_frames(tmp_path, max_held):
+    from streaming import StreamingDetector
+
+    path = tmp_path / "late_tail.h5"
+    shutil.copy(SAMPLE, path)
+    with h5py.File(path, "a") as f:
+        tail = list(get_node_names(f)).index(config["nodes"]["tail"])
+        f["tracks"][0, :, tail, :100] = np.nan
+        node_names = get_node_names(f)
+    run_config = dict(config, output_folder=str(tmp_path / "results"), feature_folder=None)
+    os.makedirs(run_config["output_folder"])
+    expected = analyze_h5(str(path), run_config)
+    assert len(expected)
+
+    detector = StreamingDetector(run_config, max_held)
+    candidates = []
+    with h5py.File(path, "r") as f:
+        for start, locations in iter_track_chunks(f, node_names, 7):
+            candidates.append(detector.update(locations))
+            assert detector.held_frames < max_held
+    candidates.append(detector.finish())
+    np.testing.assert_array_equal(np.concatenate(candidates), expected)
+
+
+# The Kalman filter of the original code, one sample at a time
+def reference_kalman_filter(data, R, Q):
+    x = np.zeros(len(data))
+    x[0] = data[np.flatnonzero(~np.isnan(data))[0]]
+    P = 1.0
+    for k in range(1, len(data)):
+        if np.isnan(data[k]):
+            x[k] = x[k - 1]
+        else:
+            P_predict = P + Q
+            K = P_predict / (P_predict + R)
+            x[k] = x[k - 1] + K * (data[k] - x[k - 1])
+            P = (1 - K) * P_predict
+    return x
+
+
+@pytest.mark.parametrize("R, Q", [(1e-5, 1e-5), (config["R"], config["Q"]), (1.0, 1e-6)])
+def test_kalman_filter_matches_reference(R, Q):
+    rng = np.random.default_rng(1)
+    data = np.cumsum(rng.normal(size=(3000, 3)), axis=0)
+    data[:5, 0] = np.nan  # Leading gap
+    data[100:400, 1] = np.nan  # Gap during the transient
+    data[rng.random(3000) < 0.2, 2] = np.nan  # Scattered gaps
+    expected = np.column_stack([reference_kalman_filter(column, R, Q) for column in data.T])
+
+    for column in range(3):
+        np.testing.assert_allclose(kalman_filter(data[:, column], R, Q), expected[:, column], rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(kalman_filter_batch(data, R, Q), expected, rtol=1e-9, atol=1e-9)
+
+
+# The gains stop once the error covariance changes by less than tol, and later
+# gains of the reference recursion stay within about tol of the last one
+@pytest.mark.parametrize("tol", [1e-6, 1e-12, 0.0])
+def test_kalman_gains_stop_at_tol(tol):
+    R, Q = config["R"], config["Q"]
+    gains = kalman_gains(R, Q, tol=tol)
+    assert not gains.flags.writeable
+
+    reference = []
+    P = 1.0
+    for _ in range(len(gains) + 1000):
+        P_predict = P + Q
+        reference.append(P_predict / (P_predict + R))
+        P = (1 - reference[-1]) * P_predict
+    np.testing.assert_array_equal(gains, reference[:len(gains)])
+    np.testing.assert_allclose(reference[len(gains):], gains[-1], rtol=max(100 * tol, 1e-15))
+    if tol:
+        assert len(gains) < len(kalman_gains(R, Q, tol=tol / 1000)) <= len(kalman_gains(R, Q, tol=0.0))
+
+
+# Stand-in for a SLEAP command: fails its first attempts, then sleeps and writes
+# its output, logging when it ran
+STUB_COMMAND = """
+import os, sys, time
+output, seconds, failures = sys.argv[1], float(sys.argv[2]), int(sys.argv[3])
+with open(output + ".attempts", "a") as f:
+    f.write("x")
+with open(output + ".attempts") as f:
+    if len(f.read()) <= failures:
+        sys.exit("stub failure")
+start = time.time()
+time.sleep(seconds)
+with open(output, "w") as f:
+    f.write("output")
+with open(os.path.join(os.path.dirname(output), "runs.log"), "a") as f:
+    f.write(f"{os.path.basename(output)} {start} {time.time()}\\n")
+"""
+
+
+def test_job_scheduler(tmp_path):
+    import sys
+    from sleap_jobs import Job, JobScheduler
+
+    stub = tmp_path / "stub.py"
+    stub.write_text(STUB_COMMAND)
+    source = tmp_path / "source"
+    source.write_text("input")
+
+    scheduler = JobScheduler(max_concurrent=2, retries=1, retry_delay=0, verbose=False)
+
+    def add(name, seconds=0.3, failures=0, depends_on=()):
+        output = tmp_path / name
+        command = [sys.executable, stub, output, seconds, failures]
+        return scheduler.add(Job(name, command, [source], [output], depends_on))
+
+    first, second, third = add("first"), add("second"), add("third")
+    after_first = add("after_first", depends_on=[first])
+    flaky = add("flaky", failures=1)
+    broken = add("broken", failures=99)
+    after_broken = add("after_broken", depends_on=[broken])
+    after_after_broken = add("after_after_broken", depends_on=[after_broken])
+
+    # An output newer than its input is not written again, and its dependents run
+    current = add("current")
+    (tmp_path / "current").write_text("old output")
+    os.utime(source, (0, 0))
+    after_current = add("after_current", depends_on=[current])
+
+    scheduler.run()
+
+    assert {job.name: job.status for job in scheduler.jobs} == {
+        "first": "done", "second": "done", "third": "done", "after_first": "done", "flaky": "done",
+        "broken": "failed", "after_broken": "cancelled", "after_after_broken": "cancelled",
+        "current": "skipped", "after_current": "done"}
+    assert [job.attempts for job in (first, flaky, broken, after_broken, current)] == [1, 2, 2, 0, 0]
+    assert "stub failure" in broken.error
+    assert (tmp_path / "current").read_text() == "old output"
+
+    # At most max_concurrent jobs ran at once, and dependents only after their dependencies
+    runs = {}
+    for line in (tmp_path / "runs.log").read_text().splitlines():
+        name, start, end = line.split()
+        runs[name] = (float(start), float(end))
+    assert sorted(runs) == sorted(["first", "second", "third", "after_first", "flaky", "after_current"])
+    running = max(sum(start <= moment < end for start, end in runs.values()) for moment, _ in runs.values())
+    assert running == 2
+    assert runs["after_first"][0] >= runs["first"][1]
@@ -1 +0,0 @@
-C:\Users\Wolff_Lab\anaconda3\envs\sleap\Scripts\sleap-track "C:\Users\Wolff_Lab\Head_twitch\Videos\v40-33740.mp4" -m "C:\Users\Wolff_Lab\Head_twitch\Mice Master N\models\240716_170449.single_instance.n=1996\training_config.json" --tracking.tracker none -o "C:\Users\Wolff_Lab\Head_twitch\transform_result\v40-33740.mp4.predictions.slp" --verbosity json --no-empty-frames
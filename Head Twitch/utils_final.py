@@ -1,42 +1,227 @@
 import os
+import json
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
+from scipy.signal import lfilter
+
+# Read the locations of the named body parts of one instance from a SLEAP
+# analysis HDF5 file, for frames start to stop. Only the requested nodes and
+# frames are read from the "tracks" dataset, which is stored as
+# (instances, 2, nodes, frames). SLEAP predictions (.slp) files, or an
+# SlpTracks of one, are read with SlpTracks instead, so they need no
+# conversion. Returns a dictionary of contiguous (frames, 2) arrays keyed by
+# node name.
+def load_tracks(f, node_names, instance=0, start=0, stop=None):
+    if not isinstance(f, SlpTracks) and "tracks" not in f:
+        f = SlpTracks(f)
+    node_indices = resolve_nodes(f, node_names)
+    if isinstance(f, SlpTracks):
+        tracks = f.read(start, stop)
+        return {name: np.ascontiguousarray(tracks[:, index, :, instance]) for name, index in zip(node_names, node_indices)}
+
+    # h5py needs increasing indices for a list selection
+    unique_indices, positions = np.unique(node_indices, return_inverse=True)
+    block = f["tracks"][instance, :, unique_indices.tolist(), start:stop]
+
+    return {name: np.ascontiguousarray(block[:, position, :].T)
+            for name, position in zip(node_names, positions)}
+
+# Read the locations of the named body parts in windows of chunk_size frames,
+# yielding the first frame of each window and its locations as load_tracks
+def iter_track_chunks(f, node_names, chunk_size, instance=0):
+    if "tracks" in f:
+        length = f["tracks"].shape[-1]
+    else:
+        # The frames table of a predictions file is only read once
+        f = SlpTracks(f)
+        length = f.length
+    for start in range(0, length, chunk_size):
+        yield start, load_tracks(f, node_names, instance, start, min(start + chunk_size, length))
+
+# Indices of the named nodes in a SLEAP analysis or predictions file
+def resolve_nodes(f, node_names):
+    file_node_names = get_node_names(f)
+    missing = [name for name in node_names if name not in file_node_names]
+    if missing:
+        raise KeyError(f"Nodes {missing} not found in {f.filename}, which has nodes {file_node_names}")
+    return [file_node_names.index(name) for name in node_names]
+
+# Node names of a SLEAP analysis file, or of the skeleton of a predictions file
+def get_node_names(f):
+    if isinstance(f, SlpTracks):
+        return f.node_names
+    if "node_names" in f:
+        return [n.decode() if isinstance(n, bytes) else str(n) for n in f["node_names"][:]]
+    metadata = f["metadata"].attrs["json"]
+    metadata = json.loads(metadata.decode() if isinstance(metadata, bytes) else metadata)
+    return [metadata["nodes"][node["id"]]["name"] for node in metadata["skeletons"][0]["nodes"]]
+
+# Tracks of one video of a SLEAP predictions (.slp) file, laid out as
+# sleap-convert writes them to an analysis file. The frames table, one row per
+# frame with instances, is read once and sorted by frame. Each window of frames
+# then only reads the rows of the instances and points tables it needs, found
+# by binary search, so reading a file in chunks costs no more than reading it
+# at once.
+class SlpTracks:
+    def __init__(self, f, video=0):
+        self.f = f
+        self.filename = f.filename
+        self.node_names = get_node_names(f)
+        frames = f["frames"][:]
+        frames = frames[frames["video"] == video]
+        self.frames = frames[np.argsort(frames["frame_idx"], kind="stable")]
+        self.frame_indices = self.frames["frame_idx"].astype(np.int64)
+        self.length = int(self.frame_indices[-1]) + 1 if len(frames) else 0
+
+        # One slot per track, or for as many instances as a frame has
+        counts = (self.frames["instance_id_end"] - self.frames["instance_id_start"]).astype(np.int64)
+        track_count = len(f["tracks_json"]) if "tracks_json" in f else 0
+        self.slot_count = max(track_count, int(counts.max()) if len(counts) else 0)
+
+    def __repr__(self):
+        return f"SlpTracks of {self.length} frames from {self.filename}"
+
+    # Tracks for frames start to stop as (frames, nodes, 2, instances).
+    # Instances with a track take the slot of their track, others their order
+    # in the frame, user instances first. Predictions replaced by a user
+    # instance are left out. Frames without instances, such as those dropped by
+    # --no-empty-frames, and invisible points are NaN.
+    def read(self, start=0, stop=None):
+        start, stop, _ = slice(start, stop).indices(self.length)
+        node_count = len(self.node_names)
+        tracks = np.full((max(stop - start, 0), node_count, 2, self.slot_count), np.nan)
+
+        first_row, last_row = np.searchsorted(self.frame_indices, [start, stop])
+        frames = self.frames[first_row:last_row]
+        counts = (frames["instance_id_end"] - frames["instance_id_start"]).astype(np.int64)
+        if counts.sum() == 0:
+            return tracks
+
+        # Instances of the window, each with the row of its frame, read as one slice
+        frame_rows = np.repeat(np.arange(len(frames)), counts)
+        first_of_frame = np.repeat(np.cumsum(counts) - counts, counts)
+        instance_ids = np.repeat(frames["instance_id_start"].astype(np.int64), counts) + np.arange(counts.sum()) - first_of_frame
+        first_id = instance_ids.min()
+        instances = self.f["instances"][first_id:instance_ids.max() + 1][instance_ids - first_id]
+
+        user = instances["instance_type"] == 0
+        replaced = ~user & np.isin(instances["instance_id"], instances["from_predicted"][user])
+        frame_rows, instances, user = frame_rows[~replaced], instances[~replaced], user[~replaced]
+
+        # Slot of each instance: its track, or its order in the frame with user instances first
+        order = np.lexsort((~user, frame_rows))
+        frame_rows, instances, user = frame_rows[order], instances[order], user[order]
+        order_in_frame = np.arange(len(frame_rows)) - np.searchsorted(frame_rows, frame_rows)
+        slots = np.where(instances["track"] >= 0, instances["track"], order_in_frame)
+
+        frame_offsets = frames["frame_idx"][frame_rows].astype(np.int64) - start
+        for points_name, selected in (("points", user), ("pred_points", ~user)):
+            if not selected.any():
+                continue
+            point_ids = instances["point_id_start"][selected].astype(np.int64)[:, np.newaxis] + np.arange(node_count)
+            first, last = point_ids.min(), point_ids.max() + 1
+            points = self.f[points_name][first:last][point_ids - first]  # (instances, nodes)
+            xy = np.stack((points["x"], points["y"]), axis=-1)
+            xy[~points["visible"]] = np.nan
+            tracks[frame_offsets[selected], :, :, slots[selected]] = xy
+        return tracks
+
+# Read the tracks of a SLEAP predictions (.slp) file for frames start to stop,
+# transposed from the analysis file layout to (frames, nodes, 2, instances),
+# see SlpTracks.read
+def read_slp_tracks(f, start=0, stop=None, video=0):
+    return SlpTracks(f, video).read(start, stop)
 
 # Kalman filter implementation to smooth noisy data
 def kalman_filter(data, R=1e-5, Q=1e-5):
-    length = len(data)
-    x = np.zeros(length)  # Initialize state vector
-    P = np.zeros(length)  # Initialize error covariance
-    K = np.zeros(length)  # Initialize Kalman gain
-
-    # Find the first non-NaN value
-    idx = 0
-    while np.isnan(data[idx]):
-        idx += 1
-
-    # Initialize with the first valid data point
-    x[0] = data[idx]
-    P[0] = 1.0
-
-    for k in range(1, length):
-        if np.isnan(data[k]):
-            # Skip NaN values, no update
-            x[k] = x[k - 1]
-            P[k] = P[k - 1]
-        else:
-            # Prediction step
-            x_predict = x[k - 1]
-            P_predict = P[k - 1] + Q
-
-            # Update step
-            K[k] = P_predict / (P_predict + R)
-            x[k] = x_predict + K[k] * (data[k] - x_predict)
-            P[k] = (1 - K[k]) * P_predict
-
+    return kalman_filter_batch(np.asarray(data)[:, np.newaxis], R, Q)[:, 0]
+
+# Kalman gains of the scalar random walk filter for successive updates.
+# The gains depend only on how many updates have been made, not on the data,
+# and converge to a steady state. Returns the gains up to the first steady
+# state gain, which applies to every later update. The error covariance is
+# steady once it changes by less than a relative tol, as it may never settle
+# on one float. The gains are kept for each R and Q, as every chunk of a
+# recording needs them, and are returned read-only.
+@lru_cache(maxsize=16)
+def kalman_gains(R=1e-5, Q=1e-5, limit=10**6, tol=1e-12):
+    gains = []
+    P = 1.0
+    while len(gains) < limit:
+        P_predict = P + Q
+        K = P_predict / (P_predict + R)
+        gains.append(K)
+        P_next = (1 - K) * P_predict
+        if abs(P_next - P) <= tol * abs(P):
+            break
+        P = P_next
+    gains = np.array(gains)
+    gains.flags.writeable = False
+    return gains
+
+# Batched Kalman filter over the columns of a (frames, channels) array.
+# Matches kalman_filter on each column: NaN samples hold the previous
+# estimate and the first frame is initialised with the first valid value.
+def kalman_filter_batch(data, R=1e-5, Q=1e-5):
+    x, _ = kalman_filter_chunk(data, R, Q)
     return x
 
+# Kalman filter one chunk of a longer (frames, channels) recording, continuing
+# from the state returned for the previous chunk, or starting the filter if
+# state is None. The state is the latest estimate and number of updates of
+# each channel. Filtering chunk by chunk gives exactly the same estimates as
+# filtering at once, provided the first chunk has a valid value in every channel.
+# Otherwise a channel starts from its first valid value in a later chunk, and
+# its estimates in the chunks before are NaN.
+def kalman_filter_chunk(data, R=1e-5, Q=1e-5, state=None):
+    data = np.asarray(data, dtype=float)
+    length, channels = data.shape
+    valid = ~np.isnan(data)
+    updates = valid.copy()
+
+    if state is None:
+        updates[:1] = False  # The first frame only initialises the state
+        # Initialise with the first valid value, NaN for channels without one
+        first_valid = np.argmax(valid, axis=0)
+        initial = np.where(valid.any(axis=0), data[first_valid, np.arange(channels)], np.nan)
+        state = (initial, np.zeros(channels, dtype=int))
+    latest, update_count = state
+    update_counts = np.cumsum(updates, axis=0)
+
+    gains = kalman_gains(R, Q)
+    steady = len(gains) - 1
+    x = np.empty(data.shape)
+
+    for channel in range(channels):
+        measurements = data[updates[:, channel], channel]
+        estimates = np.empty(len(measurements) + 1)
+        estimates[0] = latest[channel]
+        if np.isnan(estimates[0]) and len(measurements):
+            # Not tracked in the previous chunks, start from the first valid value
+            estimates[0] = measurements[0]
+        count = update_count[channel]
+
+        # Transient gains one update at a time, then the steady state gain
+        # as a constant coefficient recurrence
+        transient = min(max(steady - count, 0), len(measurements))
+        for k in range(transient):
+            estimates[k + 1] = estimates[k] + gains[count + k] * (measurements[k] - estimates[k])
+        if len(measurements) > transient:
+            K = gains[-1]
+            estimates[transient + 1:], _ = lfilter(
+                [K], [1, K - 1], measurements[transient:],
+                zi=[(1 - K) * estimates[transient]])
+
+        # Frames without a measurement hold the latest estimate
+        x[:, channel] = estimates[update_counts[:, channel]]
+
+    if length:
+        state = (x[-1].copy(), update_count + update_counts[-1])
+    return x, state
+
 # Function to interpolate NaN values
 def interpolate_nans(data):
     nans, x = np.isnan(data), lambda z: z.nonzero()[0]
@@ -55,101 +240,99 @@ def remove_exceeding_frames_with_nan(data, exceeding_frames, window=1):
     Returns:
     - filtered_exceeding_frames: List of frames with NaN values adjacent removed.
     """
-    filtered_exceeding_frames = []
+    exceeding_frames = np.asarray(exceeding_frames, dtype=int)
+    return exceeding_frames[~nan_window_mask(data, window, exceeding_frames)]
 
-    # Convert to a numpy array for easier indexing
-    data = np.array(data)
-    
-    # Create a mask for NaNs in the dataset
-    nan_mask = np.isnan(data)
+def nan_window_mask(data, window=1, frames=None):
+    """
+    Mark frames which have a NaN value within window frames of them.
 
-    for frame in exceeding_frames:
-        # Define the range of adjacent frames to check
-        start_idx = max(frame - window, 0)
-        end_idx = min(frame + window + 1, len(data))
-        
-        # Check if any adjacent frame is NaN
-        if not np.any(nan_mask[start_idx:end_idx]):
-            filtered_exceeding_frames.append(frame)
+    Parameters:
+    - data: The dataset, with frames along the first axis, to check for NaNs.
+    - window: Number of frames before and after each frame to check for NaNs.
+    - frames: Frames to check. Defaults to every frame of data.
 
-    return np.array(filtered_exceeding_frames)
+    Returns:
+    - mask: Boolean array, True for frames with a NaN value in their window.
+    """
+    data = np.asarray(data, dtype=float)
+    nan_frames = np.isnan(data.reshape(len(data), -1)).any(axis=1)
+    if frames is None:
+        frames = np.arange(len(data))
+
+    # Number of NaN frames in each window from a running count
+    nan_count = np.concatenate(([0], np.cumsum(nan_frames)))
+    start = np.clip(np.asarray(frames) - window, 0, len(data))
+    end = np.clip(np.asarray(frames) + window + 1, 0, len(data))
+    return nan_count[end] > nan_count[start]
 
 # Calculate dynamics (distance, velocity, acceleration) for body parts
 def calculate_dynamics(nose_loc, tail_loc, back_loc, earL_loc, earR_loc):
-    length = len(tail_loc)
-
-    nose_loc_filtered_x = nose_loc[:, 0, 0]
-    nose_loc_filtered_y = nose_loc[:, 1, 0]
-        
-
-    # Arrays to store distances and velocities
-    dist_body_to_earL, dist_body_to_earR = [], []
-    velocity_to_earL, velocity_to_earR = [], []
-    acceleration_to_earL, acceleration_to_earR = [], []
-
-    # Compute distances for each frame
-    for index in range(length):  
-        # nose = nose_loc[index, :, 0]
-        tail = tail_loc[index, :, 0]
-        back = back_loc[index, :, 0]
-        earL = earL_loc[index, :, 0]
-        earR = earR_loc[index, :, 0]
-
-        # Define the body vector from nose to tail
-        body_vector = np.array([(tail[0] + back[0]) / 2 - nose_loc_filtered_x[index], (tail[1] + back[1]) / 2 - nose_loc_filtered_y[index]])
-
-        # Define the ear vectors from nose to each ear
-        earL_vector = np.array([earL[0] - nose_loc_filtered_x[index], earL[1] - nose_loc_filtered_y[index]])
-        earR_vector = np.array([earR[0] - nose_loc_filtered_x[index], earR[1] - nose_loc_filtered_y[index]])
-
-        # Calculate projections of ear vectors onto the body vector
-        proj_earL = (np.dot(earL_vector, body_vector) / np.dot(body_vector, body_vector)) * body_vector
-        proj_earR = (np.dot(earR_vector, body_vector) / np.dot(body_vector, body_vector)) * body_vector
-
-        # Calculate perpendicular distances from the ears to the body vector
-        dist_to_earL = np.linalg.norm(earL_vector - proj_earL)
-        dist_to_earR = np.linalg.norm(earR_vector - proj_earR)
-
-        dist_body_to_earL.append(dist_to_earL)
-        dist_body_to_earR.append(dist_to_earR)
-
-    # Compute velocities (approximated as differences in distance)
-    for i in range(1, length):
-        vel_to_earL = (dist_body_to_earL[i] - dist_body_to_earL[i - 1]) / 1  # Assuming constant interval of 1 frame
-        vel_to_earR = (dist_body_to_earR[i] - dist_body_to_earR[i - 1]) / 1  # Assuming constant interval of 1 frame
-        velocity_to_earL.append(vel_to_earL)
-        velocity_to_earR.append(vel_to_earR)
-
-    # Compute accelerations (approximated as differences in velocity)
-    for i in range(1, len(velocity_to_earL)):
-        acc_to_earL = (velocity_to_earL[i] - velocity_to_earL[i - 1]) / 1  # Assuming constant interval of 1 frame
-        acc_to_earR = (velocity_to_earR[i] - velocity_to_earR[i - 1]) / 1  # Assuming constant interval of 1 frame
-        acceleration_to_earL.append(acc_to_earL)
-        acceleration_to_earR.append(acc_to_earR)
-
-    return (np.array(dist_body_to_earL), np.array(dist_body_to_earR), 
-            np.array(velocity_to_earL), np.array(velocity_to_earR), 
-            np.array(acceleration_to_earL), np.array(acceleration_to_earR))
+    nose = nose_loc[:, :, 0]
+
+    # Define the body vector from nose to the midpoint of back and tail
+    body_vector = (tail_loc[:, :, 0] + back_loc[:, :, 0]) / 2 - nose
+    body_length = np.sqrt(np.einsum('ij,ij->i', body_vector, body_vector))
+
+    # Perpendicular distances from the ears to the body vector, as the 2-D
+    # cross product of each ear vector with the body vector over its length
+    dist_body_to_earL = np.abs(cross_2d(earL_loc[:, :, 0] - nose, body_vector)) / body_length
+    dist_body_to_earR = np.abs(cross_2d(earR_loc[:, :, 0] - nose, body_vector)) / body_length
+
+    # Velocities and accelerations as differences over a constant interval of 1 frame
+    velocity_to_earL, velocity_to_earR = np.diff(dist_body_to_earL), np.diff(dist_body_to_earR)
+    acceleration_to_earL, acceleration_to_earR = np.diff(velocity_to_earL), np.diff(velocity_to_earR)
+
+    return (dist_body_to_earL, dist_body_to_earR,
+            velocity_to_earL, velocity_to_earR,
+            acceleration_to_earL, acceleration_to_earR)
+
+# Per-frame features used to find head twitch candidates, from the (frames, 2)
+# locations of each body part, as analyze_h5 in head_twitch.py computes them.
+# Nose, back and tail are Kalman filtered. Velocities are NaN for the first
+# frame and accelerations for the first two, so every array has one row per
+# frame. nan_window marks frames with a NaN nose location in or next to them.
+def calculate_frame_features(nose_loc, earL_loc, earR_loc, back_loc, tail_loc, R=1e-5, Q=1e-5):
+    filtered = kalman_filter_batch(np.hstack((nose_loc, back_loc, tail_loc)), R, Q)
+    nose_loc_filtered, back_loc_filtered, tail_loc_filtered = filtered[:, 0:2], filtered[:, 2:4], filtered[:, 4:6]
+
+    dist_body_to_earL, dist_body_to_earR, velocity_to_earL, velocity_to_earR, acceleration_to_earL, acceleration_to_earR = calculate_dynamics(
+        nose_loc_filtered[:, :, np.newaxis], tail_loc_filtered[:, :, np.newaxis], back_loc_filtered[:, :, np.newaxis],
+        earL_loc[:, :, np.newaxis], earR_loc[:, :, np.newaxis]
+    )
+    velocity_to_earL, velocity_to_earR = (np.concatenate(([np.nan], velocity)) for velocity in (velocity_to_earL, velocity_to_earR))
+    acceleration_to_earL, acceleration_to_earR = (np.concatenate(([np.nan, np.nan], acceleration))[:len(filtered)]
+                                                  for acceleration in (acceleration_to_earL, acceleration_to_earR))
+
+    return {
+        "nose_filtered": nose_loc_filtered,
+        "back_filtered": back_loc_filtered,
+        "tail_filtered": tail_loc_filtered,
+        "dist_body_to_earL": dist_body_to_earL,
+        "dist_body_to_earR": dist_body_to_earR,
+        "velocity_to_earL": velocity_to_earL[:len(filtered)],
+        "velocity_to_earR": velocity_to_earR[:len(filtered)],
+        "acceleration_to_earL": acceleration_to_earL,
+        "acceleration_to_earR": acceleration_to_earR,
+        "acc_sum": np.abs(acceleration_to_earR) + np.abs(acceleration_to_earL),
+        "angle": calculate_angles(nose_loc_filtered, back_loc_filtered, tail_loc_filtered),
+        "dist_nose_to_line": calculate_nose_to_line_distances(nose_loc_filtered, earL_loc, earR_loc),
+        "nan_window": nan_window_mask(nose_loc),
+    }
 
 # Calculate combined dynamics for both ears
 def calculate_combined_dynamics(dist_body_to_earL, dist_body_to_earR):
-    length = len(dist_body_to_earL)
-
-    # Arrays to store combined distances, velocities, and accelerations
     dist = dist_body_to_earL + dist_body_to_earR
-    vel, acc = [], []
 
-    # Compute velocities (approximated as differences in distance)
-    for i in range(1, length):
-        velocity = (dist[i] - dist[i - 1]) / 1  # Assuming constant interval of 1 frame
-        vel.append(velocity)
+    # Velocities and accelerations as differences over a constant interval of 1 frame
+    vel = np.diff(dist)
+    acc = np.diff(vel)
 
-    # Compute accelerations (approximated as differences in velocity)
-    for i in range(1, len(vel)):
-        acceleration = (vel[i] - vel[i - 1]) / 1  # Assuming constant interval of 1 frame
-        acc.append(acceleration)
+    return dist, vel, acc
 
-    return dist, np.array(vel), np.array(acc)
+# Row-wise 2-D cross product of two (frames, 2) arrays
+def cross_2d(a, b):
+    return a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
 
 # Plot dynamics with highlighted exceeding frames
 def plot_dynamics(acceleration_to_earL, acceleration_to_earR, exceeding_frames_L, exceeding_frames_R, folder_name, filename, save_figure=False):
@@ -221,39 +404,79 @@ def plot_dynamics(acceleration_to_earL, acceleration_to_earR, exceeding_frames_L
        plt.close()
 
 
-# Calculate distances from the nose to the line defined by the ears for exceeding frames
-def calculate_distances_for_exceeding_frames(nose_loc, earL_loc, earR_loc, array, threshold):
+# Save the data plotted by plot_dynamics to a compact sidecar file, so that
+# figures can be rendered separately from the analysis. parameters records the
+# settings the candidates were found with, see saved_parameters.
+def save_dynamics(acceleration_to_earL, acceleration_to_earR, exceeding_frames_L, exceeding_frames_R, folder_name, filename, parameters=""):
+    sidecar_path = os.path.join(folder_name, f"{filename}_dynamics.npz")
+    np.savez_compressed(
+        sidecar_path,
+        acceleration_to_earL=np.asarray(acceleration_to_earL),
+        acceleration_to_earR=np.asarray(acceleration_to_earR),
+        exceeding_frames_L=np.asarray(exceeding_frames_L, dtype=int),
+        exceeding_frames_R=np.asarray(exceeding_frames_R, dtype=int),
+        filename=filename,
+        parameters=parameters,
+    )
+    return sidecar_path
+
+# Settings a sidecar file was saved with, None if there is no sidecar file or
+# it does not record them
+def saved_parameters(sidecar_path):
+    if not os.path.exists(sidecar_path):
+        return None
+    with np.load(sidecar_path) as dynamics:
+        return str(dynamics["parameters"]) if "parameters" in dynamics.files else None
+
+# Render the figure of a sidecar file written by save_dynamics, saved next to it
+def plot_dynamics_file(sidecar_path):
+    folder_name = os.path.dirname(sidecar_path)
+    with np.load(sidecar_path) as dynamics:
+        filename = str(dynamics["filename"])
+        plot_dynamics(dynamics["acceleration_to_earL"], dynamics["acceleration_to_earR"],
+                      dynamics["exceeding_frames_L"], dynamics["exceeding_frames_R"],
+                      folder_name, filename, save_figure=True)
+    return os.path.join(folder_name, f"{filename}_plot.png")
+
+# Use the non-interactive Agg backend, for plot worker processes
+def use_agg_backend():
+    plt.switch_backend("Agg")
+
+
+# Calculate distances from the nose to the line defined by the ears for exceeding frames.
+# With candidates_only, distances are only computed for the frames in array and
+# dist_nose_to_line holds the distances of those frames that are in range.
+# Locations of several instances use the given instance.
+def calculate_distances_for_exceeding_frames(nose_loc, earL_loc, earR_loc, array, threshold, candidates_only=False, instance=0):
     length = len(nose_loc)
-    dist_nose_to_line = []
-
-    # Calculate the perpendicular distance from the nose to the line formed by the ears
-    for index in range(length):
-        nose = nose_loc[index, :, 0]
-        earL = earL_loc[index, :, 0]
-        earR = earR_loc[index, :, 0]
-
-        # Vector from left ear to right ear
-        AB = earR - earL
-        # Vector from left ear to nose
-        AP = nose - earL
-
-        # Cross product gives area of parallelogram formed by AB and AP
-        cross_product = np.cross(AB, AP)
-        # Normalize cross product to get height (distance) of parallelogram
-        norm_cross_product = np.linalg.norm(cross_product)
-        norm_AB = np.linalg.norm(AB)
-
-        # Distance from nose to line (height of parallelogram)
-        distance = norm_cross_product / norm_AB
-        dist_nose_to_line.append(distance)
-
-    dist_nose_to_line = np.array(dist_nose_to_line)
     array = np.asarray(array).astype(int)
-    
+    frames = array[(array >= 0) & (array < length)]
+
+    if candidates_only:
+        dist_nose_to_line = calculate_nose_to_line_distances(nose_loc, earL_loc, earR_loc, frames, instance)
+        frame_distances = dist_nose_to_line
+    else:
+        dist_nose_to_line = calculate_nose_to_line_distances(nose_loc, earL_loc, earR_loc, instance=instance)
+        frame_distances = dist_nose_to_line[frames]
+
     # Filter frames where distance exceeds threshold
-    filtered_exceeding_frames = [frame for frame in array if 0 <= frame < length and dist_nose_to_line[frame] >= threshold]
+    filtered_exceeding_frames = frames[frame_distances >= threshold]
+
+    return dist_nose_to_line, np.sort(filtered_exceeding_frames)
+
+# Perpendicular distance from the nose to the line through both ears, for all
+# frames or only the given frames
+def calculate_nose_to_line_distances(nose_loc, earL_loc, earR_loc, frames=None, instance=0):
+    nose, earL, earR = (as_points(loc, frames, instance) for loc in (nose_loc, earL_loc, earR_loc))
 
-    return dist_nose_to_line, np.sort(np.array(filtered_exceeding_frames))
+    # Vector from left ear to right ear
+    AB = earR - earL
+    # Vector from left ear to nose
+    AP = nose - earL
+
+    # Area of the parallelogram formed by AB and AP over the length of its
+    # base AB is its height, the distance from nose to line
+    return np.abs(cross_2d(AB, AP)) / np.hypot(AB[:, 0], AB[:, 1])
 
 # Calculate the angle between two vectors
 def angle_between_vectors(v1, v2):
@@ -261,50 +484,44 @@ def angle_between_vectors(v1, v2):
     angle = np.arctan2(np.linalg.norm(np.cross(v1, v2)), np.dot(v1, v2))
     return np.degrees(angle)
 
-# Calculate angles formed by vectors from nose to back and back to tail
-def calculate_angles(nose_loc, back_loc, tail_loc):
-    angles = []
-    for i in range(len(nose_loc)):
-        nose = nose_loc[i]
-        back = back_loc[i]
-        tail = tail_loc[i]
-
-        # Vectors from nose to back and back to tail
-        mid_body = nose - back
-        body_to_tail = tail - back
-        
-        # Flatten the vectors to 1D
-        mid_body = mid_body.flatten()
-        body_to_tail = body_to_tail.flatten()
-        
-        # Calculate angle between vectors
-        angle = angle_between_vectors(mid_body, body_to_tail)
-        angles.append(angle)
-    
-    return angles
+# Calculate angles formed by vectors from nose to back and back to tail, for
+# all frames or only the given frames
+def calculate_angles(nose_loc, back_loc, tail_loc, frames=None, instance=0):
+    nose, back, tail = (as_points(loc, frames, instance) for loc in (nose_loc, back_loc, tail_loc))
+
+    # Vectors from nose to back and back to tail
+    mid_body = nose - back
+    body_to_tail = tail - back
+
+    # Angle between the vectors in degrees, using arctan2 for better numerical stability
+    angles = np.arctan2(np.abs(cross_2d(mid_body, body_to_tail)),
+                        np.einsum('ij,ij->i', mid_body, body_to_tail))
+    return np.degrees(angles)
+
+# (frames, 2) array of the locations of one body part, optionally at the given
+# frames only. Locations given as (frames, 2, instances) use the given instance.
+def as_points(loc, frames=None, instance=0):
+    loc = np.asarray(loc)
+    if loc.ndim == 3:
+        loc = loc[..., instance]
+    if frames is not None:
+        loc = loc[np.asarray(frames, dtype=int)]
+    return loc.reshape(len(loc), 2)
 
 # Calculate angles for frames exceeding certain criteria
 def calculate_angles_for_exceeding_frames(angles, combined_exceeding_frames):
-    # Ensure that combined_exceeding_frames is a list of integers
-    combined_exceeding_frames = [int(frame) for frame in combined_exceeding_frames]
+    angles = np.asarray(angles)
+    frames = np.asarray(combined_exceeding_frames, dtype=int)
+    frames = frames[frames < len(angles)]
+    frame_angles = angles[frames]
 
     # Filter angles that are below 100 degrees or NaN for the exceeding frames
-    angles_below_90 = [
-        [frame, angles[frame]] for frame in combined_exceeding_frames
-        if frame < len(angles) and (np.isnan(angles[frame]) or angles[frame] < 100)
-    ]
-    
-    angles_below_90_array = np.array(angles_below_90)
-    
-    # Exclude angles below 90 degrees
-    new_angles = [
-        [int(frame), angles[int(frame)]] for frame in combined_exceeding_frames
-        if int(frame) < len(angles) and all(int(frame) != item[0] for item in angles_below_90_array)
-    ]
-    
-    # Convert the list to a NumPy array with integer indices
-    new_angles_array = np.array(new_angles, dtype=int)
-    
+    below_90 = np.isnan(frame_angles) | (frame_angles < 100)
+    angles_below_90_array = np.column_stack((frames[below_90], frame_angles[below_90]))
+
+    # Exclude angles below 90 degrees, with integer indices
+    new_angles_array = np.column_stack((frames[~below_90], frame_angles[~below_90])).astype(int)
+
     return angles_below_90_array, new_angles_array
 
 # Fill missing values in data using interpolation
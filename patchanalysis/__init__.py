@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""
+Pincer whole-cell patch clamp analysis. The TimeSpan types are available from
+the package itself, as used throughout the measures and analyses.
+"""
+from patchanalysis.span import TimeSpan, NullSpan, FullSpan
@@ -8,7 +8,8 @@ Created on Fri May 24 16:14:31 2024
 from patchanalysis.workers import Analysis
 from patchanalysis import TimeSpan, NullSpan, FullSpan
 
-from patchanalysis.measures.basic import area_under_curve, ap_count
+from patchanalysis.measures.basic import ap_count
+from patchanalysis.measures.vectorized import area_under_curve
 from patchanalysis.measures.currentramp import ap_threshold, firstthreeratio, input_resistance, rheobase
 
 import numpy as np
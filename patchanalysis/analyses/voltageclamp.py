@@ -6,7 +6,7 @@ Created on Mon Jun  3 12:03:19 2024
 """
 
 from patchanalysis.workers import Analysis
-from patchanalysis.measures.basic import peak_magnitude
+from patchanalysis.measures.vectorized import peak_magnitude
 from patchanalysis.span import TimeSpan
 
 class PairedPulse_withSealTest(Analysis):
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark for the analyses in patchanalysis, run on synthetic
+recordings so that no lab data is required.
+
+Synthetic recordings implement the parts of the pyabf.ABF interface used by
+measures (sampleRate, sweepCount, setSweep, sweepX, sweepY, sweepC and their
+units) and are generated for each analysis:
+
+    current ramp  -> CurrentRamp
+    paired pulse  -> PairedPulse_withSealTest
+    spike train   -> Stim_Events
+
+Each analysis is timed end to end through Analysis.process, and each of its
+measures is timed on its own. Results are written as JSON so that they can
+be compared across commits. Every analysis is first run once untimed, and the
+benchmark stops with a BenchmarkError if any measure fails, so timings are
+only reported for analyses which produce results.
+
+Usage, from the root of the repository with Python 3.12 or later, which
+patchanalysis.workers requires:
+    python -m patchanalysis.benchmark --files 20 --sweeps 50 --output bench.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from patchanalysis.span import TimeSpan
+from patchanalysis.analyses.currentclamp import Stim_Events, CurrentRamp
+from patchanalysis.analyses.voltageclamp import PairedPulse_withSealTest
+
+
+class BenchmarkError(Exception):
+    """Raised when a benchmarked analysis or measure fails on synthetic data"""
+
+
+class SyntheticABF:
+    def __init__(self, sweepsY: np.ndarray, sweepsC: np.ndarray, sampleRate: int,
+                 unitsY: str, unitsC: str, abfFilePath: str = 'synthetic'):
+        """
+        Minimal stand in for pyabf.ABF holding generated sweeps.
+
+        Parameters
+        ----------
+        sweepsY : np.ndarray
+            (sweeps, samples) array of recorded traces.
+        sweepsC : np.ndarray
+            (sweeps, samples) array of command waveforms.
+        sampleRate : int
+            Sample rate in Hz.
+        unitsY, unitsC : str
+            Units of the recorded trace and the command waveform.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.abfFilePath = abfFilePath
+        self.sampleRate = sampleRate
+        self.dataRate = sampleRate
+        self.sweepCount = len(sweepsY)
+        self.sweepPointCount = sweepsY.shape[1]
+        self.sweepUnitsY = unitsY
+        self.sweepUnitsC = unitsC
+        self.sweepUnitsX = 'sec'
+        self._sweepsY = sweepsY
+        self._sweepsC = sweepsC
+        self.setSweep(0)
+
+    def __repr__(self):
+        return f'Pincer SyntheticABF with {self.sweepCount} sweeps at {self.sampleRate} Hz'
+
+    def setSweep(self, sweepNumber: int):
+        self.sweepNumber = sweepNumber
+        self.sweepY = self._sweepsY[sweepNumber]
+        self.sweepC = self._sweepsC[sweepNumber]
+        self.sweepX = np.arange(self.sweepPointCount) / self.sampleRate
+
+
+def _add_spikes(trace: np.ndarray, sampleRate: int, threshold: float, refractory_ms: float = 5):
+    """Internal utility method adding 1 ms action potentials where trace crosses threshold"""
+    width = max(sampleRate // 1000, 1)
+    refractory = int(sampleRate * refractory_ms / 1000)
+    crossings = np.flatnonzero((trace[1:] >= threshold) & (trace[:-1] < threshold)) + 1
+    spiked = trace.copy()
+    last = -refractory
+    for crossing in crossings:
+        if crossing - last < refractory:
+            continue
+        spiked[crossing:crossing + width] = 30
+        last = crossing
+    return spiked
+
+
+def current_ramp(sweepCount: int = 10, sampleRate: int = 20000, duration: float = 1.0,
+                 seed: int = 0) -> SyntheticABF:
+    """
+    Current clamp sweeps with a current ramp in the middle 80% of each sweep,
+    driving the membrane potential through threshold to fire action potentials.
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(sampleRate * duration)
+    ramp = np.zeros(samples)
+    start, end = samples // 10, samples - samples // 10
+    ramp[start:end] = np.linspace(0, 400, end - start)
+    sweepsC = np.tile(ramp, (sweepCount, 1))
+    sweepsY = np.empty((sweepCount, samples))
+    for sweep in range(sweepCount):
+        resistance = rng.uniform(0.08, 0.12)
+        trace = -70 + resistance * ramp + rng.normal(0, 0.2, samples)
+        sweepsY[sweep] = _add_spikes(trace, sampleRate, threshold=-45)
+    return SyntheticABF(sweepsY, sweepsC, sampleRate, 'mV', 'pA')
+
+
+def paired_pulse(sweepCount: int = 10, sampleRate: int = 20000, duration: float = 1.0,
+                 seed: int = 0) -> SyntheticABF:
+    """
+    Voltage clamp sweeps with a seal test step at 100 ms and two evoked
+    inward currents at 300 ms and 350 ms.
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(sampleRate * duration)
+    time_ms = np.arange(samples) * 1000 / sampleRate
+    command = np.where((time_ms >= 100) & (time_ms < 150), -5.0, 0.0)
+    sweepsC = np.tile(command, (sweepCount, 1))
+    sweepsY = np.empty((sweepCount, samples))
+    for sweep in range(sweepCount):
+        trace = rng.normal(0, 2, samples)
+        since_step = np.clip(time_ms - 100, 0, None)
+        trace += np.where(time_ms >= 100, -400 * np.exp(-since_step / 0.5), 0)
+        for onset, amplitude in ((300, rng.uniform(80, 120)), (350, rng.uniform(100, 160))):
+            since_pulse = np.clip(time_ms - onset, 0, None)
+            trace -= amplitude * (since_pulse / 2) * np.exp(1 - since_pulse / 2)
+        sweepsY[sweep] = trace
+    return SyntheticABF(sweepsY, sweepsC, sampleRate, 'pA', 'mV')
+
+
+def spike_train(sweepCount: int = 10, sampleRate: int = 20000, duration: float = 1.0,
+                stims: int = 3, seed: int = 0) -> SyntheticABF:
+    """
+    Current clamp sweeps with a train of stims light pulses, starting at
+    300 ms and 100 ms apart, each evoking a depolarization and action
+    potentials.
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(sampleRate * duration)
+    time_ms = np.arange(samples) * 1000 / sampleRate
+    sweepsC = np.zeros((sweepCount, samples))
+    sweepsY = np.empty((sweepCount, samples))
+    for sweep in range(sweepCount):
+        trace = -70 + rng.normal(0, 0.2, samples)
+        for stim in range(stims):
+            since_stim = np.clip(time_ms - (300 + 100 * stim), 0, None)
+            trace += rng.uniform(20, 35) * (since_stim / 5) * np.exp(1 - since_stim / 5)
+        sweepsY[sweep] = _add_spikes(trace, sampleRate, threshold=-45)
+    return SyntheticABF(sweepsY, sweepsC, sampleRate, 'mV', 'pA')
+
+
+def benchmark_suite():
+    """
+    Returns the benchmarked analyses as name: (analysis factory, recording
+    generator) pairs.
+    """
+    return {
+        'Stim_Events': (lambda: Stim_Events(stims_per_trace=3,
+                                            baseline=TimeSpan((0, 200))),
+                        spike_train),
+        'CurrentRamp': (CurrentRamp, current_ramp),
+        'PairedPulse_withSealTest': (lambda: PairedPulse_withSealTest(TimeSpan((0, 90)),
+                                                                      TimeSpan((300, 350)),
+                                                                      TimeSpan((350, 400)),
+                                                                      TimeSpan((90, 100)),
+                                                                      TimeSpan((100, 110)),
+                                                                      binsize=0),
+                                     paired_pulse),
+    }
+
+
+def run_benchmark(files: int = 10, sweeps: int = 10, sampleRate: int = 20000,
+                  duration: float = 1.0, repeats: int = 3, analyses: list = None) -> dict:
+    """
+    Run every analysis in benchmark_suite on synthetic recordings.
+
+    Parameters
+    ----------
+    files : int, optional
+        Number of synthetic recordings per analysis. The default is 10.
+    sweeps : int, optional
+        Sweeps per recording. The default is 10.
+    sampleRate : int, optional
+        Sample rate in Hz. The default is 20000.
+    duration : float, optional
+        Length of each sweep in seconds. The default is 1.0.
+    repeats : int, optional
+        Number of timed runs, of which the fastest is reported. The default
+        is 3.
+    analyses : list, optional
+        Names of the analyses to run. The default is all of them.
+
+    Raises
+    ------
+    BenchmarkError
+        Raised if an analysis reports errors or any of its measures raises.
+
+    Returns
+    -------
+    dict
+        Timings per analysis and per measure, and the peak resident memory.
+
+    """
+    report = {'commit': _git_commit(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'pandas': pd.__version__,
+              'config': {'files': files, 'sweeps': sweeps, 'sampleRate': sampleRate,
+                         'duration': duration, 'repeats': repeats},
+              'analyses': {}}
+    for name, (make_analysis, generator) in benchmark_suite().items():
+        if analyses is not None and name not in analyses:
+            continue
+        recordings = {f'{name}_{index}.abf': generator(sweeps, sampleRate, duration, seed=index)
+                      for index in range(files)}
+        filepathsDF = pd.DataFrame({'Filepath': list(recordings)},
+                                   index=[f'recording{index}' for index in range(files)])
+        _check(name, make_analysis(), filepathsDF, recordings)
+        result = {'measures': {}}
+
+        # Whole analysis, through Analysis.process
+        elapsed = min(_timed(make_analysis().process, filepathsDF,
+                             loader=recordings.__getitem__)
+                      for _ in range(repeats))
+        result['total_s'] = elapsed
+        result['per_file_s'] = elapsed / files
+        result['files_per_s'] = files / elapsed if elapsed else None
+
+        # Each measure on its own
+        for measure in make_analysis().measures:
+            elapsed = min(sum(_timed(measure['function'], abffile)
+                              for abffile in recordings.values())
+                          for _ in range(repeats))
+            result['measures'][measure['name']] = {'total_s': elapsed,
+                                                   'per_file_s': elapsed / files}
+        report['analyses'][name] = result
+    report['peak_rss_kb'] = _peak_rss_kb()
+    return report
+
+
+def _check(name: str, analysis, filepathsDF: pd.DataFrame, recordings: dict):
+    """
+    Internal utility method running analysis once on the recordings, raising
+    a BenchmarkError if it reports errors or any of its measures raises
+    """
+    try:
+        _, errors = analysis.process(filepathsDF, loader=recordings.__getitem__)
+        for measure in analysis.measures:
+            for abffile in recordings.values():
+                measure['function'](abffile)
+    except Exception as error:
+        raise BenchmarkError(f'{name}: {type(error).__name__}: {error}') from error
+    if errors:
+        raise BenchmarkError(f'{name}: ' + '; '.join(errors))
+
+
+def _timed(func, *args, **kwargs) -> float:
+    """Internal utility method returning the wall time of a single call"""
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _peak_rss_kb():
+    """Internal utility method reporting peak resident memory, None if unavailable"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _git_commit():
+    """Internal utility method returning the current commit, if in a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--sweeps', type=int, default=10)
+    parser.add_argument('--samplerate', type=int, default=20000)
+    parser.add_argument('--duration', type=float, default=1.0)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--analysis', action='append', dest='analyses',
+                        help='Analysis to run, may be given more than once. Default is all.')
+    parser.add_argument('--output', help='JSON file to write. Default is stdout.')
+    args = parser.parse_args(argv)
+    report = run_benchmark(args.files, args.sweeps, args.samplerate, args.duration,
+                           args.repeats, args.analyses)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
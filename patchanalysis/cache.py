@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of per-recording analysis results, so that
+rerunning an analysis over a spreadsheet only opens recordings which are new
+or have changed since the last run.
+"""
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from patchanalysis.span import TimeSpan
+
+
+class ResultCache:
+    def __init__(self, directory: str, max_bytes: int = 2**30, hash_content: bool = False):
+        """
+        Create a ResultCache storing one entry per recording and analysis.
+
+        Parameters
+        ----------
+        directory : str
+            Folder in which cache entries are stored. Created if missing.
+        max_bytes : int, optional
+            Size cap for all entries. When exceeded, the least recently used
+            entries are evicted. The cache keeps a running total of its size
+            and only lists its entries once it goes over the cap, so entries
+            written by other processes are counted from then on. The default
+            is 1 GiB.
+        hash_content : bool, optional
+            If True, recordings are identified by a hash of their contents.
+            Otherwise the path, size and modification time of the file are
+            used, which avoids reading the file. The default is False.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        self._total = None  # Running size of all entries, counted on first put
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return f'Pincer ResultCache at {self.directory}'
+
+    def get(self, filepath: str, fingerprint: str):
+        """
+        Return the cached (row, errors) for filepath under the analysis
+        fingerprint, or None if there is no valid entry.
+        """
+        try:
+            entrypath = self._entrypath(filepath, fingerprint)
+            with open(entrypath, 'rb') as entry:
+                result = pickle.load(entry)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        # Reading an entry marks it as recently used for LRU eviction. A cache
+        # which cannot be written, such as a shared one, is still read.
+        try:
+            os.utime(entrypath)
+        except OSError:
+            pass
+        return result
+
+    def put(self, filepath: str, fingerprint: str, row: dict, errors: list):
+        """
+        Store the results of an analysis of filepath, removing entries for
+        earlier versions of the file, then enforce max_bytes
+        """
+        try:
+            entrypath = self._entrypath(filepath, fingerprint)
+        except OSError:
+            return
+        if self._total is None:
+            self._total = self.size
+        folder = os.path.dirname(entrypath)
+        os.makedirs(folder, exist_ok=True)
+        # Entries of the file are named by its state, so only entries of its
+        # current state are kept. The replaced entry is also uncounted here.
+        state = os.path.basename(entrypath).split('_')[0]
+        for name in os.listdir(folder):
+            if name.endswith('.pkl') and (not name.startswith(state + '_')
+                                          or name == os.path.basename(entrypath)):
+                self._total -= self._remove(os.path.join(folder, name))
+        # Write to a temporary file and move it in place so that concurrent
+        # workers never read a partially written entry.
+        handle, temppath = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as entry:
+            pickle.dump((row, errors), entry)
+        os.replace(temppath, entrypath)
+        self._total += os.path.getsize(entrypath)
+        if self._total > self.max_bytes:
+            self._evict()
+
+    def invalidate(self, filepath: str = None):
+        """
+        Remove every cached entry for filepath, or all entries if filepath
+        is None.
+        """
+        if filepath is None:
+            folders = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        else:
+            folders = [os.path.join(self.directory, self._pathkey(filepath))]
+        for folder in folders:
+            if os.path.isdir(folder):
+                shutil.rmtree(folder, ignore_errors=True)
+        self._total = None
+
+    @property
+    def size(self):
+        """Reports the total size in bytes of all cache entries"""
+        return sum(size for _, size, _ in self._entries())
+
+    def _entrypath(self, filepath: str, fingerprint: str):
+        """Internal utility method giving the cache entry path for filepath"""
+        state = hashlib.sha256(self._filekey(filepath).encode()).hexdigest()[:16]
+        key = hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, self._pathkey(filepath), f'{state}_{key}.pkl')
+
+    def _filekey(self, filepath: str):
+        """Internal utility method identifying the current state of filepath"""
+        if self.hash_content:
+            digest = hashlib.sha256()
+            with open(filepath, 'rb') as file:
+                for chunk in iter(lambda: file.read(2**20), b''):
+                    digest.update(chunk)
+            return digest.hexdigest()
+        stat = os.stat(filepath)
+        return f'{os.path.abspath(filepath)}|{stat.st_size}|{stat.st_mtime_ns}'
+
+    @staticmethod
+    def _pathkey(filepath: str):
+        """Internal utility method giving a short stable key for a file path"""
+        return hashlib.sha256(os.path.abspath(filepath).encode()).hexdigest()[:16]
+
+    def _entries(self):
+        """Internal utility method listing (path, size, last use) of each entry"""
+        entries = []
+        for folder in os.listdir(self.directory):
+            try:
+                names = os.listdir(os.path.join(self.directory, folder))
+            except (NotADirectoryError, FileNotFoundError):
+                continue
+            for name in names:
+                if not name.endswith('.pkl'):
+                    continue
+                entrypath = os.path.join(self.directory, folder, name)
+                try:
+                    stat = os.stat(entrypath)
+                except FileNotFoundError:
+                    continue
+                entries.append((entrypath, stat.st_size, stat.st_mtime_ns))
+        return entries
+
+    @staticmethod
+    def _remove(entrypath: str):
+        """Internal utility method removing an entry, returning its size"""
+        try:
+            size = os.path.getsize(entrypath)
+            os.remove(entrypath)
+        except FileNotFoundError:
+            return 0
+        return size
+
+    def _evict(self):
+        """
+        Internal utility method removing least recently used entries. Lists
+        every entry, so the total also takes in entries of other processes.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for entrypath, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total <= self.max_bytes:
+                break
+            self._remove(entrypath)
+            total -= size
+        self._total = total
+
+
+def fingerprint(*objs) -> str:
+    """
+    Create a stable hash describing objs, used to tell whether an analysis
+    has changed between runs. Measure functions are described by their name,
+    code and the values they close over, such as TimeSpans and directions,
+    so two analyses constructed with the same parameters share a fingerprint.
+    """
+    return hashlib.sha256(_describe(objs).encode()).hexdigest()
+
+
+def _describe(obj, _seen=None):
+    """Internal utility method producing a stable string describing obj"""
+    if _seen is None:
+        _seen = set()
+    if isinstance(obj, TimeSpan):
+        return f'TimeSpan({type(obj).__name__}, {obj.region}, {obj.unit}, {getattr(obj, "factor", None)})'
+    if isinstance(obj, (list, tuple)):
+        return '(' + ', '.join(_describe(item, _seen) for item in obj) + ')'
+    if isinstance(obj, dict):
+        return '{' + ', '.join(f'{_describe(key, _seen)}: {_describe(value, _seen)}'
+                               for key, value in obj.items()) + '}'
+    if isinstance(obj, type):
+        return f'{obj.__module__}.{obj.__qualname__}'
+    if callable(obj) and hasattr(obj, '__code__'):
+        if id(obj) in _seen:
+            return f'{obj.__module__}.{obj.__qualname__}'
+        _seen.add(id(obj))
+        cells = []
+        for cell in obj.__closure__ or ():
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:
+                cells.append(None)
+        # Decorated measures keep the measure itself in __wrapped__
+        wrapped = _describe(getattr(obj, '__wrapped__', None), _seen)
+        return f'{obj.__module__}.{obj.__qualname__}[{_describecode(obj.__code__)}]{_describe(cells, _seen)}{wrapped}'
+    if callable(obj) and hasattr(obj, '__qualname__'):
+        return f'{getattr(obj, "__module__", None)}.{obj.__qualname__}'
+    return repr(obj)
+
+
+def _describecode(code) -> str:
+    """Internal utility method hashing a code object and any nested code"""
+    digest = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            digest.update(_describecode(const).encode())
+        else:
+            digest.update(repr(const).encode())
+    return digest.hexdigest()
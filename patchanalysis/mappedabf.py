@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped alternative to pyabf.ABF for recordings too large to hold in
+memory in full.
+"""
+import numpy as np
+import pyabf
+
+
+class MappedABF(pyabf.ABF):
+    def __init__(self, abfFilePath, **kwargs):
+        """
+        Open an ABF file without reading its data section. The data section is
+        memory-mapped, and setSweep exposes sweepY as a view onto the file so
+        only the pages of a sweep that are actually used are read from disk.
+        All other attributes (sampleRate, sweepCount, sweepX, sweepC, units)
+        behave as in pyabf.ABF, so a MappedABF can be passed to any measure.
+
+        Files storing 16-bit integer data are scaled one sweep at a time when
+        the sweep is selected, rather than all at once when the file is opened.
+
+        Measures built on acrossSweepMatrix stack every sweep into one array
+        in memory. For recordings whose sweeps exceed
+        measuretools.MATRIX_MAX_BYTES they are called one sweep at a time, so
+        lower that limit to keep memory use to about one sweep.
+
+        Parameters
+        ----------
+        abfFilePath : str
+            Path to the ABF file.
+        **kwargs
+            Passed on to pyabf.ABF, except loadData which is always False.
+
+        Returns
+        -------
+        None.
+
+        """
+        kwargs['loadData'] = False
+        super().__init__(abfFilePath, **kwargs)
+        self.setSweep(0)
+
+    def _loadAndScaleData(self, fb=None):
+        """Replaces pyabf's full read with a memory map of the data section"""
+        nRows = self.channelCount
+        nCols = int(self.dataPointCount/self.channelCount)
+        raw = np.memmap(self.abfFilePath, dtype=self._dtype, mode='r',
+                        offset=self.dataByteStart, shape=(nCols, nRows))
+        self.data = MappedData(raw.T, self._dataGain, self._dataOffset,
+                               scaled=self._dtype == np.int16)
+
+
+class MappedData:
+    """
+    Lazily scaled (channels, points) view of a memory-mapped ABF data section.
+    Indexing returns views onto the file for float data, or scales only the
+    indexed points for integer data.
+    """
+
+    def __init__(self, raw: np.ndarray, gain: list, offset: list, scaled: bool):
+        self._raw = raw
+        self._gain = np.asarray(gain, dtype=np.float32)
+        self._offset = np.asarray(offset, dtype=np.float32)
+        self._scaled = scaled
+
+    def __repr__(self):
+        return f'Pincer MappedData of shape {self.shape}'
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        block = self._raw[key]
+        if not self._scaled:
+            return block
+        # Scale in the same order and precision as pyabf so that results
+        # match those from a fully loaded file.
+        channels = np.arange(self._raw.shape[0])[key[0]]
+        if np.ndim(channels) == 1:
+            gain = self._gain[channels].reshape((-1,) + (1,)*(block.ndim - 1))
+            offset = self._offset[channels].reshape((-1,) + (1,)*(block.ndim - 1))
+        else:
+            gain, offset = self._gain[channels], self._offset[channels]
+        scaled = np.multiply(block.astype(np.float32), gain)
+        return np.add(scaled, offset)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    def __len__(self):
+        return self._raw.shape[0]
+
+    @property
+    def shape(self):
+        return self._raw.shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
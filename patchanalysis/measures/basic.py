@@ -5,26 +5,21 @@ Created on Thu May 16 19:47:10 2024
 @author: mbmad
 """
 from patchanalysis.measures.measuretools import NoResultError, InvalidRecordingError, \
-    withinEachSweep, withinEachSweepHzXuYuCu
+    withinEachSweep, withinEachSweepHzXuYuCu, trapezoid
 from patchanalysis import TimeSpan, FullSpan, NullSpan
-from patchanalysis.signal.peaks import find_peaks
+from scipy.signal import find_peaks
 import numpy as np
 
 
 def area_under_curve(region: TimeSpan = FullSpan(),
                      baseline: TimeSpan = NullSpan(),
                      direction: int = -1) -> np.float64: 
-    timespan_parameters = [region, baseline]
-
-    @withinEachSweep('sampleRate', 'sweepX', 'sweepUnitsY', 'sweepY', 'sweepUnitsY')
-    def measure(hz, sweepX, sweepUnitsX, sweepY, sweepUnitsY) -> float:
-        for param in timespan_parameters:
-            param.convertto_samples(hz)
-            
-        trace = baseline.baseline(sweepY)
-        trace = region.crop(trace)
+    @withinEachSweep('sampleRate', 'sweepX', 'sweepUnitsY', 'sweepY', 'sweepUnitsY', 'sweepCache')
+    def measure(hz, sweepX, sweepUnitsX, sweepY, sweepUnitsY, sweepCache) -> float:
+        trace = sweepCache.get(('baseline', baseline), baseline.samples(hz).baseline, sweepY)
+        trace = region.samples(hz).crop(trace)
         trace = trace * direction
-        auc = np.trapz(trace)/(hz/1000)
+        auc = trapezoid(trace)/(hz/1000)
         return np.float64(auc)
     return measure
 
@@ -34,15 +29,10 @@ def ap_count(region: TimeSpan = FullSpan(),
              threshold: (float, int) = None,
              stims_per_sweep: int = 1
              ):
-    timespan_parameters = [region]
-
     @withinEachSweep('sampleRate', 'sweepX', 'sweepUnitsY', 'sweepY', 'sweepUnitsY')
     def measure(hz, sweepX, sweepUnitsX, sweepY, sweepUnitsY) -> float:
-        for param in timespan_parameters:
-            param.convertto_samples(hz)
-            
-        trace = region.crop(sweepY)
-        peaks = find_peaks(trace, threshold)
+        trace = region.samples(hz).crop(sweepY)
+        peaks = find_peaks(trace, height=threshold)[0]
         return len(peaks) / stims_per_sweep
     return measure
 
@@ -55,15 +45,10 @@ def count_events(region: TimeSpan == FullSpan(),
                  distance=None,
                  prominence=None,
                  ):
-    timespan_parameters = [region, baseline]
-
-    @withinEachSweep('sampleRate', 'sweepX', 'sweepUnitsY', 'sweepY', 'sweepUnitsY')
-    def measure(hz, sweepX, sweepUnitsX, sweepY, sweepUnitsY) -> float:
-        for param in timespan_parameters:
-            param.convertto_samples(hz)
-
-        trace = baseline.baseline(sweepY)
-        trace = region.crop(trace)
+    @withinEachSweep('sampleRate', 'sweepX', 'sweepUnitsY', 'sweepY', 'sweepUnitsY', 'sweepCache')
+    def measure(hz, sweepX, sweepUnitsX, sweepY, sweepUnitsY, sweepCache) -> float:
+        trace = sweepCache.get(('baseline', baseline), baseline.samples(hz).baseline, sweepY)
+        trace = region.samples(hz).crop(trace)
         trace = trace * direction
         peaklist = find_peaks(trace,
                               height=None,
@@ -81,15 +66,10 @@ def count_events(region: TimeSpan == FullSpan(),
 def peak_magnitude(region: TimeSpan = FullSpan(),
                    baseline: TimeSpan = NullSpan(),
                    direction: int = 1):
-    timespan_parameters = [region, baseline]
-
-    @withinEachSweep('sampleRate', 'sweepY')
-    def measure(hz, sweepY):
-        for param in timespan_parameters:
-            param.convertto_samples(hz)
-
-        trace = baseline.baseline(sweepY)
-        trace = region.crop(trace)
+    @withinEachSweep('sampleRate', 'sweepY', 'sweepCache')
+    def measure(hz, sweepY, sweepCache):
+        trace = sweepCache.get(('baseline', baseline), baseline.samples(hz).baseline, sweepY)
+        trace = region.samples(hz).crop(trace)
         trace = trace * direction
 
         return np.max(trace)
@@ -12,39 +12,55 @@ from scipy.signal import find_peaks
 
 import numpy as np
     
-def ap_threshold(region: TimeSpan = FullSpan()):
-    @withinEachSweep('sweepC', 'sweepY')
-    def measure(sweepC, sweepY) -> np.float64:
+def _ramp_region(sweepCache, sweepC, sweepY):
+    """
+    Ramp portion of the trace and command, and the action potential peaks
+    within it. Memoized in the sweepCache so that all current ramp measures
+    on a sweep share one gradient and one peak search.
+    """
+    def compute():
         whereramp = np.gradient(sweepC) != 0
         trace_rampregion = sweepY[whereramp]
-        ap_peak_inds = find_peaks(trace_rampregion, threshold=-20)
-        if len(ap_peak_inds) == 0:
-            raise NoResultError('No Action Potentials')
+        command_rampregion = sweepC[whereramp]
+        ap_peak_inds = find_peaks(trace_rampregion, height=-20)[0].tolist()
+        return trace_rampregion, command_rampregion, ap_peak_inds
+    return sweepCache.get('currentramp_region', compute)
+
+
+def _ramp_rise(sweepCache, trace_rampregion, ap_peak_inds):
+    """Rising phase of the ramp before the first AP and its inflection point"""
+    def compute():
         trace_ramp_rise = trace_rampregion[:ap_peak_inds[0]]
         inflectionpoint = np.argmax(np.gradient(np.gradient(trace_ramp_rise)))-2 #correction for shifting with gradient
+        return trace_ramp_rise, inflectionpoint
+    return sweepCache.get('currentramp_rise', compute)
+
+
+def ap_threshold(region: TimeSpan = FullSpan()):
+    @withinEachSweep('sweepC', 'sweepY', 'sweepCache')
+    def measure(sweepC, sweepY, sweepCache) -> np.float64:
+        trace_rampregion, _, ap_peak_inds = _ramp_region(sweepCache, sweepC, sweepY)
+        if len(ap_peak_inds) == 0:
+            raise NoResultError('No Action Potentials')
+        trace_ramp_rise, inflectionpoint = _ramp_rise(sweepCache, trace_rampregion, ap_peak_inds)
         return np.float64(trace_ramp_rise[inflectionpoint])
     return measure
 
 def firstthreeratio(region: TimeSpan = FullSpan()):
-    @withinEachSweep('sweepC', 'sweepY')
-    def measure(sweepC, sweepY) -> np.float64:
-        whereramp = np.gradient(sweepC) != 0
-        trace_rampregion = sweepY[whereramp]
-        ap_peak_inds = find_peaks(trace_rampregion, threshold=-20)
+    @withinEachSweep('sweepC', 'sweepY', 'sweepCache')
+    def measure(sweepC, sweepY, sweepCache) -> np.float64:
+        _, _, ap_peak_inds = _ramp_region(sweepCache, sweepC, sweepY)
         if len(ap_peak_inds) < 3:
             raise NoResultError('Insuffient Number of Action Potetials')
         return np.float64((ap_peak_inds[1] - ap_peak_inds[0]) / (ap_peak_inds[2] - ap_peak_inds[1]))
     return measure
 
 def input_resistance(region: TimeSpan = FullSpan()):
-    @withinEachSweep('sweepC', 'sweepY')
-    def measure(sweepC, sweepY) -> np.float64:
-        whereramp = np.gradient(sweepC) != 0
-        trace_rampregion = sweepY[whereramp]
-        ap_peak_inds = find_peaks(trace_rampregion, threshold=-20)
+    @withinEachSweep('sweepC', 'sweepY', 'sweepCache')
+    def measure(sweepC, sweepY, sweepCache) -> np.float64:
+        trace_rampregion, _, ap_peak_inds = _ramp_region(sweepCache, sweepC, sweepY)
         if ap_peak_inds != []:
-            trace_ramp_rise = trace_rampregion[:ap_peak_inds[0]]
-            inflectionpoint = np.argmax(np.gradient(np.gradient(trace_ramp_rise)))-2 #correction for shifting with gradient
+            trace_ramp_rise, inflectionpoint = _ramp_rise(sweepCache, trace_rampregion, ap_peak_inds)
             trace_ramp_rise = trace_ramp_rise[:inflectionpoint]
         else:
             trace_ramp_rise = trace_rampregion
@@ -53,16 +69,12 @@ def input_resistance(region: TimeSpan = FullSpan()):
     return measure
 
 def rheobase(region: TimeSpan = FullSpan()):
-    @withinEachSweep('sweepC', 'sweepY')
-    def measure(sweepC, sweepY) -> np.float64:
-        whereramp = np.gradient(sweepC) != 0
-        trace_rampregion = sweepY[whereramp]
-        command_rampregion = sweepC[whereramp]
-        ap_peak_inds = find_peaks(trace_rampregion, threshold=-20)
+    @withinEachSweep('sweepC', 'sweepY', 'sweepCache')
+    def measure(sweepC, sweepY, sweepCache) -> np.float64:
+        trace_rampregion, command_rampregion, ap_peak_inds = _ramp_region(sweepCache, sweepC, sweepY)
         if ap_peak_inds == []:
             raise NoResultError('No Action Potentials')
-        trace_ramp_rise = trace_rampregion[:ap_peak_inds[0]]
-        inflectionpoint = np.argmax(np.gradient(np.gradient(trace_ramp_rise)))-2 #correction for shifting with gradient
+        _, inflectionpoint = _ramp_rise(sweepCache, trace_rampregion, ap_peak_inds)
         return np.float64(command_rampregion[inflectionpoint])
     return measure
         
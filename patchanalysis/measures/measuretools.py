@@ -5,6 +5,15 @@ Created on Fri May 10 11:34:27 2024
 @author: mbmad
 """
 from functools import cache, wraps
+import numpy as np
+
+# np.trapz was renamed np.trapezoid in NumPy 2.0 and removed in NumPy 2.4
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+# Largest size in bytes of the sweep matrices of a recording. Recordings with
+# larger matrices pass acrossSweepMatrix measures one sweep at a time instead.
+MATRIX_MAX_BYTES = 2**28
+
 
 class InvalidRecordingError(Exception):
     """
@@ -39,25 +48,175 @@ def acrossListofSweepsHzXuYuCu(func):
                               'sweepUnitsC')(func)
 
 
+class SweepCache:
+    """
+    Memo of intermediate values for a single sweep. Every measure evaluated
+    on the same sweep during a traversal receives the same SweepCache, so
+    work such as baselining a trace or finding peaks is done only once. A
+    measure requests it by naming the 'sweepCache' attribute in its
+    withinEachSweep decorator.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key, func, *args):
+        """Return the value stored under key, computing func(*args) if absent"""
+        if key not in self._values:
+            self._values[key] = func(*args)
+        return self._values[key]
+
+
 def withinEachSweep(*args):
     def decorator(func):
         @wraps(func)
         def wrapper(abffile):
-            results = []
-            for sweepnum in range(abffile.sweepCount):
-                abffile.setSweep(sweepnum)
-                attr = [getattr(abffile, arg, None) for arg in args]
-                try:
-                    res = func(*attr)
-                except NoResultError:
-                    pass
-                else:
-                    results.append(res)
+            results = traverseSweeps(abffile, [wrapper])[0]
+            if isinstance(results, InvalidRecordingError):
+                raise results
+            return results
+        wrapper.sweepfunction = func
+        wrapper.sweepattrs = args
+        return wrapper
+    return decorator
+
+
+def acrossSweepMatrix(*args):
+    """
+    Decorator for measures which operate on every sweep at once. Array
+    attributes (sweepY, sweepC, sweepX) are loaded into a single contiguous
+    (sweeps, samples) array and any other attribute (sampleRate, units) is
+    passed as its value on the first sweep. A 'sweepCache' requested here is
+    shared by every acrossSweepMatrix measure on the recording. The decorated
+    function returns one result per sweep, which is returned as a list so that
+    it can be binned like the results of withinEachSweep.
+
+    Stacking copies every sweep into memory, so recordings whose matrices
+    would exceed MATRIX_MAX_BYTES are passed one sweep at a time as
+    (1, samples) arrays instead, with a sweepCache per sweep. The decorated
+    function must therefore treat each row independently.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(abffile):
+            results = traverseSweeps(abffile, [wrapper])[0]
+            if isinstance(results, InvalidRecordingError):
+                raise results
             return results
+        wrapper.matrixfunction = func
+        wrapper.sweepattrs = args
         return wrapper
     return decorator
 
 
+def traverseSweeps(abffile, measurefuncs: list, matrix_max_bytes: int = None) -> list:
+    """
+    Walk the sweeps of abffile once for every measure in measurefuncs.
+    withinEachSweep measures are called on each sweep as it is visited, with
+    sweep attributes read from the abffile once per sweep and a single
+    SweepCache shared by all measures. The sweep matrices requested by
+    acrossSweepMatrix measures are filled during the same pass and the
+    measures are called once the pass is complete. If the matrices would
+    exceed matrix_max_bytes, acrossSweepMatrix measures are instead called on
+    each sweep as a single row, so that a memory-mapped recording is never
+    copied into memory in full.
+
+    Parameters
+    ----------
+    abffile : pyabf.ABF
+        Recording to traverse.
+    measurefuncs : list
+        Functions decorated by withinEachSweep or acrossSweepMatrix.
+    matrix_max_bytes : int, optional
+        Largest size of the sweep matrices before acrossSweepMatrix measures
+        are called one sweep at a time. The default is MATRIX_MAX_BYTES.
+
+    Returns
+    -------
+    list
+        For each function in measurefuncs, the list of its per-sweep results,
+        or the InvalidRecordingError it raised. A measure which raises is not
+        called again for the remaining sweeps.
+
+    """
+    if matrix_max_bytes is None:
+        matrix_max_bytes = MATRIX_MAX_BYTES
+    results = [[] for _ in measurefuncs]
+    matrixattrs = {arg: None for measurefunc in measurefuncs
+                   if hasattr(measurefunc, 'matrixfunction')
+                   for arg in measurefunc.sweepattrs}
+    if 'sweepCache' in matrixattrs:
+        matrixattrs['sweepCache'] = SweepCache()
+    bysweep = False  # Whether acrossSweepMatrix measures are called per sweep
+    for sweepnum in range(abffile.sweepCount):
+        abffile.setSweep(sweepnum)
+        sweepattrs = {'sweepCache': SweepCache()}
+        for arg in matrixattrs:
+            if arg != 'sweepCache':
+                sweepattrs[arg] = getattr(abffile, arg, None)
+        if sweepnum == 0:
+            arrays = [sweepattrs[arg] for arg in matrixattrs
+                      if isinstance(sweepattrs[arg], np.ndarray)]
+            bysweep = sum(array.nbytes for array in arrays)*abffile.sweepCount > matrix_max_bytes
+            for arg in matrixattrs:
+                if arg == 'sweepCache':
+                    continue
+                value = sweepattrs[arg]
+                if isinstance(value, np.ndarray) and not bysweep:
+                    matrixattrs[arg] = np.empty((abffile.sweepCount, *value.shape),
+                                                dtype=value.dtype)
+                else:
+                    matrixattrs[arg] = value
+        if bysweep:
+            # Each array as a single row, as a view so that nothing is copied
+            rowattrs = {arg: sweepattrs[arg][np.newaxis]
+                        if isinstance(sweepattrs[arg], np.ndarray) else value
+                        for arg, value in matrixattrs.items() if arg != 'sweepCache'}
+            rowattrs['sweepCache'] = SweepCache()
+        else:
+            for arg, value in matrixattrs.items():
+                if isinstance(value, np.ndarray):
+                    value[sweepnum] = sweepattrs[arg]
+        for index, measurefunc in enumerate(measurefuncs):
+            if isinstance(results[index], InvalidRecordingError):
+                continue
+            if hasattr(measurefunc, 'matrixfunction'):
+                if bysweep:
+                    attr = [rowattrs[arg] for arg in measurefunc.sweepattrs]
+                    try:
+                        results[index].extend(measurefunc.matrixfunction(*attr))
+                    except NoResultError:
+                        pass
+                    except InvalidRecordingError as error:
+                        results[index] = error
+                continue
+            if not hasattr(measurefunc, 'sweepfunction'):
+                continue
+            for arg in measurefunc.sweepattrs:
+                if arg not in sweepattrs:
+                    sweepattrs[arg] = getattr(abffile, arg, None)
+            attr = [sweepattrs[arg] for arg in measurefunc.sweepattrs]
+            try:
+                res = measurefunc.sweepfunction(*attr)
+            except NoResultError:
+                pass
+            except InvalidRecordingError as error:
+                results[index] = error
+            else:
+                results[index].append(res)
+    for index, measurefunc in enumerate(measurefuncs):
+        if not hasattr(measurefunc, 'matrixfunction') or abffile.sweepCount == 0 or bysweep:
+            continue
+        attr = [matrixattrs[arg] for arg in measurefunc.sweepattrs]
+        try:
+            results[index] = list(measurefunc.matrixfunction(*attr))
+        except NoResultError:
+            pass
+        except InvalidRecordingError as error:
+            results[index] = error
+    return results
+
+
 def acrossListofSweeps(*args):
     def decorator(func):
         @wraps(func)
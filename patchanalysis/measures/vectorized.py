@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized versions of the measures in patchanalysis.measures.basic. Each
+measure receives every sweep of a recording as a single (sweeps, samples)
+array and computes its result for all sweeps with one axis-wise operation.
+
+ap_count and count_events depend on a per-sweep peak search and remain in
+patchanalysis.measures.basic.
+"""
+from patchanalysis.measures.measuretools import acrossSweepMatrix, trapezoid
+from patchanalysis import TimeSpan, FullSpan, NullSpan
+import numpy as np
+
+
+def area_under_curve(region: TimeSpan = FullSpan(),
+                     baseline: TimeSpan = NullSpan(),
+                     direction: int = -1) -> np.ndarray:
+    @acrossSweepMatrix('sampleRate', 'sweepY', 'sweepCache')
+    def measure(hz, sweepsY, sweepCache) -> np.ndarray:
+        traces = sweepCache.get(('baseline', baseline), baseline.samples(hz).baseline, sweepsY)
+        traces = region.samples(hz).crop(traces)
+        traces = traces * direction
+        auc = trapezoid(traces, axis=-1)/(hz/1000)
+        return auc.astype(np.float64)
+    return measure
+
+
+def peak_magnitude(region: TimeSpan = FullSpan(),
+                   baseline: TimeSpan = NullSpan(),
+                   direction: int = 1) -> np.ndarray:
+    @acrossSweepMatrix('sampleRate', 'sweepY', 'sweepCache')
+    def measure(hz, sweepsY, sweepCache):
+        traces = sweepCache.get(('baseline', baseline), baseline.samples(hz).baseline, sweepsY)
+        traces = region.samples(hz).crop(traces)
+        traces = traces * direction
+
+        return np.max(traces, axis=-1)
+    return measure
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming destinations for the results of Analysis.stream. Each recording's
+row is written as soon as it has been processed, so memory use does not grow
+with the number of recordings and a crashed batch keeps everything finished
+before the crash. Rerunning a batch into the same sink skips recordings it
+already contains.
+
+Values which are not scalars, such as unbinned per-sweep results, are stored
+as JSON lists.
+"""
+import csv
+import json
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+
+class ResultsSink:
+    """
+    Base class for results sinks. Subclasses implement _existing_ids,
+    _create, _append and read.
+    """
+    index_name = 'recordingID'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.columns = None
+
+    def __repr__(self):
+        return f'Pincer {type(self).__name__} at {self.path}'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self, columns: list) -> set:
+        """
+        Prepare the sink to receive rows with the given measure columns.
+
+        Parameters
+        ----------
+        columns : list
+            Names of the measures, in column order.
+
+        Raises
+        ------
+        ValueError
+            Raised if the sink already holds results with different columns.
+
+        Returns
+        -------
+        set
+            String forms of the recording IDs already present in the sink.
+
+        """
+        self.columns = list(columns)
+        existing = self._existing_ids()
+        if existing is None:
+            self._create()
+            return set()
+        return existing
+
+    def write(self, recordingID, row: dict):
+        """Append the results of one recording to the sink"""
+        values = [_serialize(row.get(name, np.nan)) for name in self.columns]
+        self._append(str(recordingID), values)
+
+    def close(self):
+        pass
+
+    def read(self) -> pd.DataFrame:
+        """Load the contents of the sink as a DataFrame indexed by recording ID"""
+        raise NotImplementedError
+
+    def _check_columns(self, columns: list):
+        """Internal utility method rejecting a sink made for another analysis"""
+        if list(columns) != [self.index_name] + self.columns:
+            raise ValueError(f'{self.path} holds columns {list(columns)[1:]}, '
+                             f'not {self.columns}')
+
+
+class CSVSink(ResultsSink):
+    """Appends one line per recording to a CSV file, flushed after each row"""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._file = None
+        self._writer = None
+
+    def _existing_ids(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return None
+        with open(self.path, newline='') as file:
+            reader = csv.reader(file)
+            self._check_columns(next(reader))
+            existing = {line[0] for line in reader if line}
+        self._open()
+        return existing
+
+    def _create(self):
+        self._open()
+        self._writer.writerow([self.index_name] + self.columns)
+        self._file.flush()
+
+    def _open(self):
+        self._file = open(self.path, 'a', newline='')
+        self._writer = csv.writer(self._file)
+
+    def _append(self, recordingID: str, values: list):
+        self._writer.writerow([recordingID] + values)
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read(self) -> pd.DataFrame:
+        return pd.read_csv(self.path, index_col=self.index_name)
+
+
+class SQLiteSink(ResultsSink):
+    """Inserts one row per recording into a SQLite table, committed per row"""
+
+    def __init__(self, path: str, table: str = 'results'):
+        super().__init__(path)
+        self.table = table
+        self._connection = sqlite3.connect(path)
+
+    def _existing_ids(self):
+        info = self._connection.execute(
+            f'PRAGMA table_info({_quote(self.table)})').fetchall()
+        if not info:
+            return None
+        self._check_columns([column[1] for column in info])
+        return {recordingID for (recordingID,) in self._connection.execute(
+            f'SELECT {_quote(self.index_name)} FROM {_quote(self.table)}')}
+
+    def _create(self):
+        columns = ', '.join([f'{_quote(self.index_name)} TEXT PRIMARY KEY']
+                            + [_quote(name) for name in self.columns])
+        self._connection.execute(f'CREATE TABLE {_quote(self.table)} ({columns})')
+        self._connection.commit()
+
+    def _append(self, recordingID: str, values: list):
+        placeholders = ', '.join('?' * (len(values) + 1))
+        self._connection.execute(
+            f'INSERT OR REPLACE INTO {_quote(self.table)} VALUES ({placeholders})',
+            [recordingID] + values)
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def read(self) -> pd.DataFrame:
+        with sqlite3.connect(self.path) as connection:
+            return pd.read_sql(f'SELECT * FROM {_quote(self.table)}', connection,
+                               index_col=self.index_name)
+
+
+class ParquetSink(ResultsSink):
+    """
+    Writes rows to a directory of Parquet part files. Parquet files cannot be
+    appended to, so rows are buffered and written as a new part file every
+    rows_per_file rows and when the sink is closed, which Analysis.stream
+    does even when processing is interrupted. Rows still buffered when the
+    process is killed outright are lost and are processed again on resuming,
+    so rows_per_file trades the number of part files against that loss.
+    Requires pyarrow.
+    """
+
+    def __init__(self, path: str, rows_per_file: int = 10):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as error:
+            raise ImportError('ParquetSink requires pyarrow') from error
+        super().__init__(path)
+        self.rows_per_file = rows_per_file
+        self._pyarrow = pyarrow
+        self._buffer = []
+
+    def _parts(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if name.startswith('part-') and name.endswith('.parquet'))
+
+    def _existing_ids(self):
+        if not os.path.isdir(self.path) or not self._parts():
+            return None
+        existing = set()
+        for name in self._parts():
+            table = self._pyarrow.parquet.read_table(os.path.join(self.path, name))
+            self._check_columns(table.column_names)
+            existing.update(table.column(self.index_name).to_pylist())
+        return existing
+
+    def _create(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def _append(self, recordingID: str, values: list):
+        self._buffer.append([recordingID] + values)
+        if len(self._buffer) >= self.rows_per_file:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        names = [self.index_name] + self.columns
+        columns = list(zip(*self._buffer))
+        table = self._pyarrow.table({name: self._column(column)
+                                     for name, column in zip(names, columns)})
+        parts = self._parts()
+        number = int(parts[-1][5:-8]) + 1 if parts else 0
+        # Written under a temporary name so readers never see a partial file
+        partpath = os.path.join(self.path, f'part-{number:05d}.parquet')
+        self._pyarrow.parquet.write_table(table, partpath + '.tmp')
+        os.replace(partpath + '.tmp', partpath)
+        self._buffer = []
+
+    def _column(self, values: tuple):
+        """Internal utility method building a float column, or a string column
+        if any value is text (recording IDs and JSON lists)"""
+        if any(isinstance(value, str) for value in values):
+            return self._pyarrow.array([value if isinstance(value, str) else None
+                                        for value in values],
+                                       type=self._pyarrow.string())
+        return self._pyarrow.array(values, type=self._pyarrow.float64())
+
+    def close(self):
+        self._flush()
+
+    def read(self) -> pd.DataFrame:
+        frames = [pd.read_parquet(os.path.join(self.path, name))
+                  for name in self._parts()]
+        return pd.concat(frames).set_index(self.index_name)
+
+
+def _serialize(value):
+    """Internal utility method converting a result to a storable scalar"""
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return json.dumps(np.asarray(value, dtype=np.float64).tolist())
+    if value is None:
+        return np.nan
+    return float(value)
+
+
+def _quote(name: str) -> str:
+    """Internal utility method quoting a SQLite identifier"""
+    return '"' + name.replace('"', '""') + '"'
@@ -16,6 +16,10 @@ class TimeSpan:
     # Base factors are in us units
     _defaultunits = {'us': 1, 'ms': 1000, 's': 1000000, 'sec': 1000000, 'min': 60000000,
                      'Null': 10**10}
+    # Endpoints are held as an (n, 2) integer array. _origin keeps the endpoints
+    # and factor the TimeSpan was created with, and _samples caches their
+    # resolution to a SampleSpan for each sample rate.
+    __slots__ = ('_region', 'unit', 'factor', '_units', '_origin', '_samples')
 
     def __init__(self, region: Union[Span, SpanList], unit: str = 'ms', factor=None, forcecreate=False):
         """
@@ -62,8 +66,7 @@ class TimeSpan:
                 raise ValueError(
                     "Each element in the list must be a tuple of two integers.")
             region = [region]
-        self.region = region
-        self.region = self._removeoverlap(self.region)
+        self.region = self._removeoverlap(region)
 
         # Set unit and factor
         if forcecreate:
@@ -72,6 +75,17 @@ class TimeSpan:
         else:
             self.unit = unit
             self.factor = self._units[unit]
+        self._origin = (self._region, self.factor)
+        self._samples = {}
+
+    @property
+    def region(self) -> SpanList:
+        """Endpoints of the TimeSpan as a list of (start, end) tuples"""
+        return [tuple(span) for span in self._region.tolist()]
+
+    @region.setter
+    def region(self, region: SpanList):
+        self._region = np.array(region, dtype=np.int64).reshape(-1, 2)
 
     def __add__(self, other):
         """Magic method to allow TimeSpans to be added to each other (Union)"""
@@ -119,16 +133,48 @@ class TimeSpan:
             raise TypeError(f'{unit} is not a valid unit')
         if unit in self._units:
             new_factor = self._units[unit]
-        cnv_region = [tuple([(edge*self.factor) //
-                            new_factor for edge in span]) for span in self.region]
+        cnv_region = [tuple(span) for span in
+                      ((self._region*self.factor) // new_factor).tolist()]
         if region_only:
             return cnv_region
         return TimeSpan(cnv_region, unit, factor=new_factor, forcecreate=True)
 
+    def samples(self, samplerate_hz: int):
+        """
+        Resolve the TimeSpan to sample indices for a specific sample rate.
+
+        The TimeSpan itself is not changed. Resolutions are memoized per sample
+        rate, so a TimeSpan can be shared between measures, threads and
+        recordings with different sample rates without reconversion.
+
+        Parameters
+        ----------
+        samplerate_hz : int
+            Sampling rate of the recorded trace.
+
+        Returns
+        -------
+        SampleSpan
+            Immutable span of sample indices with crop and baseline methods.
+
+        """
+        new_factor = 1000000 // samplerate_hz
+        resolved = self._samples.get(new_factor)
+        if resolved is None:
+            origin_region, origin_factor = self._origin
+            resolved = self._samples.setdefault(
+                new_factor, SampleSpan((origin_region*origin_factor) // new_factor))
+        return resolved
+
     def convertto_samples(self, samplerate_hz: int):
         """
         Converts a TimeSpan object in place to 'samples' units given a specific
-        sample rate.
+        sample rate. The conversion is always made from the endpoints the
+        TimeSpan was created with and is cached for each sample rate, so
+        switching between sample rates is cheap and lossless.
+
+        Because this changes the TimeSpan, prefer samples() wherever the
+        TimeSpan may be shared.
 
         Parameters
         ----------
@@ -140,26 +186,27 @@ class TimeSpan:
         None.
 
         """
-        if self.factor == (1000000 // samplerate_hz) and self.unit == 'samples':
+        new_factor = 1000000 // samplerate_hz
+        if self.factor == new_factor and self.unit == 'samples':
             return
-        self.region = self.convertto('samples',
-                                     new_factor=1000000 // samplerate_hz,
-                                     region_only=True)
-        self.factor = 1000000 // samplerate_hz
+        self._region = self.samples(samplerate_hz)._region
+        self.factor = new_factor
         self.unit = 'samples'
 
     def crop(self, arraylike: np.ndarray):
         """
-        Crops a 1D array to the desired TimeSpan
+        Crops an array to the desired TimeSpan
 
-        This method crops the input 1D array to the specified TimeSpan regions.
-        The unit of the TimeSpan must be set to 'Samples' for the cropping to
-        be applied.
+        This method crops the input array to the specified TimeSpan regions
+        along its last axis, so a 2D (sweeps, samples) array is cropped
+        sweep by sweep. The unit of the TimeSpan must be set to 'Samples'
+        for the cropping to be applied. A TimeSpan with a single region
+        returns a view of arraylike rather than a copy.
 
         Parameters
         ----------
         arraylike : np.ndarray
-            1D array for cropping.
+            1D array, or 2D array of sweeps, for cropping.
 
         Raises
         ------
@@ -172,10 +219,9 @@ class TimeSpan:
             Cropped array.
 
         """
-        if self.unit == 'samples':
-            return np.concatenate([arraylike[slice(*region)]
-                                   for region in self.region])
-        raise TypeError('Unit must be samples to apply to array')
+        if self.unit != 'samples':
+            raise TypeError('Unit must be samples to apply to array')
+        return _crop(self._region, arraylike)
 
     def baseline(self, arraylike: np.ndarray):
         """
@@ -184,7 +230,8 @@ class TimeSpan:
         This method calculates the baseline value from the specified regions 
         and subtracts it from the input arraylike. The baseline is calculated 
         as the average value across all regions specified in the object. 
-        The unit attribute of the object must be set to 'samples' for this 
+        A 2D (sweeps, samples) array is baselined sweep by sweep. The unit
+        attribute of the object must be set to 'samples' for this 
         method to work correctly.
 
         Parameters
@@ -205,10 +252,7 @@ class TimeSpan:
         """
         if self.unit != 'samples':
             raise TypeError('Unit must be samples to apply to array')
-        baseline_regions = np.concatenate([arraylike[slice(*region)]
-                                           for region in self.region])
-        baseline_value = np.average(baseline_regions)
-        return arraylike - baseline_value
+        return _baseline(self._region, arraylike)
 
     @property
     def valid_units(self):
@@ -253,7 +297,69 @@ class TimeSpan:
         return result
 
 
+class SampleSpan:
+    """
+    Immutable span of sample indices, produced by TimeSpan.samples for one
+    sample rate. Provides the crop and baseline methods of a TimeSpan in
+    'samples' units, and can safely be shared between threads.
+    """
+    __slots__ = ('_region',)
+
+    def __init__(self, region: np.ndarray):
+        region = np.array(region, dtype=np.int64).reshape(-1, 2)
+        region.flags.writeable = False
+        object.__setattr__(self, '_region', region)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SampleSpan is immutable')
+
+    def __reduce__(self):
+        return SampleSpan, (self._region,)
+
+    def __repr__(self):
+        return 'Pincer SampleSpan including ' + ' '.join(str(x) for x in self.region).replace('(', '[') + ' in unit (samples)'
+
+    @property
+    def region(self) -> SpanList:
+        """Sample indices of the span as a list of (start, end) tuples"""
+        return [tuple(span) for span in self._region.tolist()]
+
+    def crop(self, arraylike: np.ndarray):
+        """Crops an array to the span along its last axis, see TimeSpan.crop"""
+        return _crop(self._region, arraylike)
+
+    def baseline(self, arraylike: np.ndarray):
+        """Subtracts the mean of the span from an array, see TimeSpan.baseline"""
+        return _baseline(self._region, arraylike)
+
+
+def _crop(region: np.ndarray, arraylike: np.ndarray):
+    """Internal utility method cropping arraylike to an (n, 2) sample region"""
+    if len(region) == 1:
+        start, end = region[0]
+        return arraylike[..., start:end]
+    return np.concatenate([arraylike[..., start:end]
+                           for start, end in region], axis=-1)
+
+
+def _baseline(region: np.ndarray, arraylike: np.ndarray):
+    """Internal utility method subtracting the mean of an (n, 2) sample region"""
+    if len(region) == 1:
+        start, end = region[0]
+        baseline_value = np.mean(arraylike[..., start:end], axis=-1, keepdims=True)
+        return arraylike - baseline_value
+    # Average of all regions from per-region sums, without concatenating
+    total, count = 0, 0
+    for start, end in region:
+        segment = arraylike[..., start:end]
+        total = total + np.sum(segment, axis=-1, keepdims=True)
+        count += segment.shape[-1]
+    return arraylike - total / count
+
+
 class _NullSpan(TimeSpan):
+    __slots__ = ()
+
     def __init__(self):
         self.region = []
         self.unit = 'Null'
@@ -262,11 +368,14 @@ class _NullSpan(TimeSpan):
     def __repr__(self):
         return 'Pincer TimeSpan representing no portion of the trace (null)'
 
+    def samples(self, samplerate_hz):
+        return self
+
     def convertto_samples(self, samplerate_hz):
         pass
 
     def crop(self, arraylike: np.ndarray):
-        return np.asarray([])
+        return np.asarray(arraylike)[..., :0]
 
     def baseline(self, arraylike: np.ndarray):
         return arraylike
@@ -282,6 +391,8 @@ def NullSpan(unique=False):
 
 
 class _FullSpan(TimeSpan):
+    __slots__ = ()
+
     def __init__(self):
         self.region = []
         self.unit = 'Null'
@@ -290,6 +401,9 @@ class _FullSpan(TimeSpan):
     def __repr__(self):
         return 'Pincer TimeSpan including the entire trace (dummy TimeSpan, aka FullSpan)'
 
+    def samples(self, samplerate_hz):
+        return self
+
     def convertto_samples(self, samplerate_hz):
         pass
 
@@ -297,7 +411,7 @@ class _FullSpan(TimeSpan):
         return arraylike
 
     def baseline(self, arraylike: np.ndarray):
-        baseline_value = np.average(arraylike)
+        baseline_value = np.mean(arraylike, axis=-1, keepdims=True)
         return arraylike - baseline_value
 
 
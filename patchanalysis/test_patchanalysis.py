@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for patchanalysis, run on the synthetic recordings of
+patchanalysis.benchmark so that no lab data is required. Run from the root of
+the repository with:
+
+    python -m pytest patchanalysis
+"""
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from patchanalysis import TimeSpan, FullSpan
+from patchanalysis.analyses.voltageclamp import PairedPulse_withSealTest
+from patchanalysis.benchmark import paired_pulse, spike_train
+from patchanalysis.cache import ResultCache
+from patchanalysis.sinks import CSVSink, SQLiteSink, ParquetSink
+from patchanalysis.workers import Derived_Measures
+from patchanalysis.measures import basic, vectorized
+from patchanalysis.measures.measuretools import traverseSweeps, trapezoid
+
+
+# Vectorized AUC, on the stacked sweeps or one sweep at a time, against the
+# per-sweep measure and a direct computation
+@pytest.mark.parametrize('matrix_max_bytes', [None, 0])
+def test_vectorized_auc_matches_per_sweep(matrix_max_bytes):
+    abffile = spike_train(sweepCount=4, seed=1)
+    baseline = TimeSpan((0, 200))
+    matrix, per_sweep = traverseSweeps(abffile, [vectorized.area_under_curve(FullSpan(), baseline, 1),
+                                                 basic.area_under_curve(FullSpan(), baseline, 1)],
+                                       matrix_max_bytes)
+
+    expected = []
+    for sweepnum in range(abffile.sweepCount):
+        abffile.setSweep(sweepnum)
+        trace = abffile.sweepY - abffile.sweepY[:4000].mean()
+        expected.append(trapezoid(trace)/(abffile.sampleRate/1000))
+    assert len(matrix) == abffile.sweepCount
+    np.testing.assert_allclose(matrix, per_sweep, rtol=1e-12)
+    np.testing.assert_allclose(matrix, expected, rtol=1e-12)
+
+
+# Synthetic paired pulse recording named by its filepath, such as
+# 'paired_pulse_3_7.abf' for 3 sweeps with seed 7. Others fail to load.
+def synthetic_loader(filepath):
+    if not filepath.startswith('paired_pulse_'):
+        raise ValueError(f'{filepath} not found')
+    sweeps, seed = filepath[len('paired_pulse_'):-len('.abf')].split('_')
+    return paired_pulse(int(sweeps), seed=int(seed))
+
+
+def paired_pulse_analysis():
+    return PairedPulse_withSealTest(TimeSpan((0, 90)), TimeSpan((300, 350)), TimeSpan((350, 400)),
+                                    TimeSpan((90, 100)), TimeSpan((100, 110)))
+
+
+# Recordings of different lengths, so that workers finish out of order
+@pytest.fixture
+def filepathsDF():
+    filepaths = [f'paired_pulse_{sweeps}_{seed}.abf' for seed, sweeps in enumerate([12, 1, 6, 1, 3, 9, 2, 1])]
+    filepaths.insert(3, 'missing.abf')
+    return pd.DataFrame({'Filepath': filepaths}, index=[f'recording{index}' for index in range(len(filepaths))])
+
+
+@pytest.mark.parametrize('workers, max_inflight', [(2, None), (3, 3), (2, 5)])
+def test_pooled_results_match_serial(filepathsDF, workers, max_inflight):
+    serial, serial_errors = paired_pulse_analysis().process(filepathsDF, loader=synthetic_loader)
+    pooled, pooled_errors = paired_pulse_analysis().process(filepathsDF, workers=workers, max_inflight=max_inflight,
+                                                            loader=synthetic_loader)
+    assert list(pooled.index) == [recordingID for recordingID in filepathsDF.index if recordingID != 'recording3']
+    pd.testing.assert_frame_equal(pooled, serial)
+    assert pooled_errors == serial_errors == ['missing.abf does not exist or cannot be loaded']
+
+
+# Without fork, an analysis whose measures cannot be pickled is processed serially
+def test_unpicklable_analysis_falls_back_to_serial(filepathsDF, monkeypatch):
+    serial, _ = paired_pulse_analysis().process(filepathsDF, loader=synthetic_loader)
+    monkeypatch.setattr(multiprocessing, 'get_all_start_methods', lambda: ['spawn'])
+    with pytest.warns(UserWarning, match='serially'):
+        pooled, _ = paired_pulse_analysis().process(filepathsDF, workers=2, loader=synthetic_loader)
+    pd.testing.assert_frame_equal(pooled, serial)
+
+
+# Recordings on disk for the cache, each file holding the sweeps and seed of
+# its synthetic recording. Loads are counted.
+@pytest.fixture
+def cached_recordings(tmp_path):
+    loads = []
+
+    def loader(filepath):
+        loads.append(filepath)
+        with open(filepath) as file:
+            sweeps, seed = file.read().split()
+        return paired_pulse(int(sweeps), seed=int(seed))
+
+    filepaths = []
+    for index in range(3):
+        filepath = tmp_path / f'recording{index}.abf'
+        filepath.write_text(f'{index + 1} {index}')
+        filepaths.append(str(filepath))
+    filepathsDF = pd.DataFrame({'Filepath': filepaths}, index=[f'recording{index}' for index in range(3)])
+    return filepathsDF, loader, loads
+
+
+def test_cache_hits_skip_the_loader(tmp_path, cached_recordings):
+    filepathsDF, loader, loads = cached_recordings
+    cache = ResultCache(str(tmp_path / 'cache'))
+    first, _ = paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+    assert len(loads) == 3
+    cached, _ = paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+    assert len(loads) == 3
+    pd.testing.assert_frame_equal(cached, first)
+
+    # Different parameters are a different analysis
+    changed = PairedPulse_withSealTest(TimeSpan((0, 80)), TimeSpan((300, 350)), TimeSpan((350, 400)),
+                                       TimeSpan((90, 100)), TimeSpan((100, 110)))
+    changed.process(filepathsDF, cache=cache, loader=loader)
+    assert len(loads) == 6
+
+
+def test_cache_replaces_entries_of_modified_files(tmp_path, cached_recordings):
+    filepathsDF, loader, loads = cached_recordings
+    cache = ResultCache(str(tmp_path / 'cache'))
+    paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+    filepath = filepathsDF['Filepath'].iloc[0]
+    folder = os.path.dirname(cache._entrypath(filepath, paired_pulse_analysis().fingerprint))
+    before = os.listdir(folder)
+
+    with open(filepath, 'w') as file:
+        file.write('4 10')
+    os.utime(filepath, ns=(0, 10**18))
+    results, _ = paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+    assert loads[3:] == [filepath]
+    assert len(results.iloc[0]['First Peak Magnitude']) == 4
+    after = os.listdir(folder)
+    assert len(after) == len(before) == 1 and after != before
+    assert cache.size == sum(entry[1] for entry in cache._entries())
+
+
+def test_cache_invalidate(tmp_path, cached_recordings):
+    filepathsDF, loader, loads = cached_recordings
+    cache = ResultCache(str(tmp_path / 'cache'))
+    paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+    cache.invalidate(filepathsDF['Filepath'].iloc[1])
+    paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+    assert loads[3:] == [filepathsDF['Filepath'].iloc[1]]
+    cache.invalidate()
+    assert cache.size == 0
+    paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+    assert len(loads) == 7
+
+
+def test_cache_eviction_respects_max_bytes(tmp_path, cached_recordings):
+    filepathsDF, loader, loads = cached_recordings
+    cache = ResultCache(str(tmp_path / 'cache'))
+    paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+    entry_size = max(size for _, size, _ in cache._entries())
+
+    # Room for two entries, so the least recently used is evicted
+    cache = ResultCache(str(tmp_path / 'small'), max_bytes=2 * entry_size + 1)
+    for index in range(3):
+        paired_pulse_analysis().process(filepathsDF.iloc[[index]], cache=cache, loader=loader)
+        os.utime(cache._entrypath(filepathsDF['Filepath'].iloc[index], paired_pulse_analysis().fingerprint),
+                 ns=(index * 10**9, index * 10**9))
+        assert cache.size <= cache.max_bytes
+    assert cache.get(filepathsDF['Filepath'].iloc[0], paired_pulse_analysis().fingerprint) is None
+    assert cache.get(filepathsDF['Filepath'].iloc[2], paired_pulse_analysis().fingerprint) is not None
+
+
+# A cache which cannot be written is still read
+def test_read_only_cache_hits(tmp_path, cached_recordings, monkeypatch):
+    filepathsDF, loader, loads = cached_recordings
+    cache = ResultCache(str(tmp_path / 'cache'))
+    paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+
+    def utime(*args, **kwargs):
+        raise PermissionError('read-only')
+    monkeypatch.setattr(os, 'utime', utime)
+    paired_pulse_analysis().process(filepathsDF, cache=cache, loader=loader)
+    assert len(loads) == 3
+
+
+class Interrupted(Exception):
+    pass
+
+
+def make_sink(kind, tmp_path):
+    if kind == 'csv':
+        return CSVSink(str(tmp_path / 'results.csv'))
+    if kind == 'sqlite':
+        return SQLiteSink(str(tmp_path / 'results.sqlite'))
+    return ParquetSink(str(tmp_path / 'results.parquet'), rows_per_file=2)
+
+
+# A batch interrupted after three recordings, then resumed into the same sink,
+# has every recording once, and only the unfinished ones are processed again
+@pytest.mark.parametrize('kind', ['csv', 'sqlite', 'parquet'])
+def test_sink_resumes_after_interrupt(kind, tmp_path, filepathsDF):
+    analysis = PairedPulse_withSealTest(TimeSpan((0, 90)), TimeSpan((300, 350)), TimeSpan((350, 400)),
+                                        TimeSpan((90, 100)), TimeSpan((100, 110)), binsize=0)
+    expected, _ = analysis.process(filepathsDF, loader=synthetic_loader)
+
+    loads = []
+
+    def interrupting_loader(filepath):
+        if len(loads) == 3:
+            raise Interrupted
+        loads.append(filepath)
+        return synthetic_loader(filepath)
+    with pytest.raises(Interrupted):
+        analysis.stream(filepathsDF, make_sink(kind, tmp_path), loader=interrupting_loader)
+    finished = make_sink(kind, tmp_path)
+    existing = finished.start([measure['name'] for measure in analysis.measures])
+    assert existing == {'recording0', 'recording1', 'recording2'}
+    finished.close()
+
+    loads.clear()
+    errors = analysis.stream(filepathsDF, make_sink(kind, tmp_path),
+                             loader=lambda filepath: loads.append(filepath) or synthetic_loader(filepath))
+    assert loads == list(filepathsDF['Filepath'].iloc[3:])
+    assert errors == ['missing.abf does not exist or cannot be loaded']
+
+    results = make_sink(kind, tmp_path).read()
+    assert sorted(results.index) == sorted(expected.index)
+    np.testing.assert_allclose(results.loc[expected.index].to_numpy(dtype=float), expected.to_numpy(dtype=float))
+
+
+@pytest.mark.parametrize('kind', ['csv', 'sqlite', 'parquet'])
+def test_sink_rejects_other_columns(kind, tmp_path, filepathsDF):
+    paired_pulse_analysis().stream(filepathsDF.iloc[:2], make_sink(kind, tmp_path), loader=synthetic_loader)
+    with make_sink(kind, tmp_path) as sink, pytest.raises(ValueError, match='holds columns'):
+        sink.start(['First Peak Magnitude', 'Other'])
+
+
+# Derived measures given every row at once match those given one row at a time
+def test_vectorized_derived_measures_match_rowwise(filepathsDF):
+    analysis = PairedPulse_withSealTest(TimeSpan((0, 90)), TimeSpan((300, 350)), TimeSpan((350, 400)),
+                                        TimeSpan((90, 100)), TimeSpan((100, 110)), binsize=0)
+    results, _ = analysis.process(filepathsDF, loader=synthetic_loader)
+    resultsFrame = pd.concat({'PairedPulse': results}, axis=1)
+    first, second = ('PairedPulse', 'First Peak Magnitude'), ('PairedPulse', 'Second Peak Magnitude')
+    capacitive = ('PairedPulse', 'Capacitive Current Peak')
+
+    def ratio(row):
+        return row[second] / row[first]
+
+    def normalized(row):
+        return (row[first] + row[second]) / row[capacitive]
+
+    derived = {}
+    for vectorized in (False, True):
+        measures = Derived_Measures('Derived')
+        measures.add_measure([first, second], ratio, 'Paired Pulse Ratio', vectorized=vectorized)
+        measures.add_measure([first, second, capacitive], normalized, 'Normalized', dtype=np.float32,
+                             vectorized=vectorized)
+        derived[vectorized] = measures.process(resultsFrame)
+    pd.testing.assert_frame_equal(derived[True], derived[False])
+    np.testing.assert_allclose(derived[True][('Derived', 'Paired Pulse Ratio')],
+                               results['Second Peak Magnitude'] / results['First Peak Magnitude'])
+    assert derived[True][('Derived', 'Normalized')].dtype == np.float32
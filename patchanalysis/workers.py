@@ -4,10 +4,16 @@ Created on Thu May  9 20:36:51 2024
 
 @author: mbmad
 """
+import multiprocessing
+import pickle
+import warnings
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 import pandas as pd
 import pyabf
-from patchanalysis.measures.measuretools import InvalidRecordingError, NoResultError
+from patchanalysis.cache import ResultCache, fingerprint
+from patchanalysis.measures.measuretools import InvalidRecordingError, NoResultError, \
+    traverseSweeps
 from typing import Union
 
 
@@ -35,39 +41,293 @@ class Analysis():
                 f'{name} already exists as a measure')
         self.measures.append({'name': name,
                               'function': makebinnedfunction(func, binsize, binfunction),
+                              'unbinned_function': func,
                               'binsize': binsize,
                               'binfunction': binfunction,
-                              'dtype': dtype
+                              'dtype': dtype,
+                              'fingerprint': fingerprint(name, dtype, binsize,
+                                                         binfunction, func)
                               })
 
+    @property
+    def fingerprint(self):
+        """Reports a hash of every measure in the analysis, used by ResultCache"""
+        return fingerprint(type(self).__name__,
+                           [measure['fingerprint'] for measure in self.measures])
+
     def add_expectation(self):
         pass
 
-    def process(self, filepathsDF, report=False):
+    def process(self, filepathsDF, report=False, workers: int = None, max_inflight: int = None,
+                cache: ResultCache = None, loader=None):
+        """
+        Apply every measure of the analysis to each recording in filepathsDF.
+
+        Parameters
+        ----------
+        filepathsDF : pd.DataFrame
+            Dataframe with a 'Filepath' column, indexed by recording ID.
+        report : bool, optional
+            If True, prints each filepath as it is opened. The default is False.
+        workers : int, optional
+            Number of worker processes to spread recordings across. None or 1
+            processes every recording serially in this process. Workers are
+            forked where the platform allows it. Elsewhere, such as on
+            Windows, the analysis must be pickled to reach them, and if it
+            cannot be the recordings are processed serially with a warning.
+            The default is None.
+        max_inflight : int, optional
+            Maximum number of recordings submitted to the worker pool at once,
+            which keeps memory bounded for very large spreadsheets. Defaults
+            to twice the number of workers.
+        cache : ResultCache, optional
+            If given, recordings whose file and analysis are unchanged since
+            they were cached are returned from the cache without being opened,
+            and newly processed recordings are added to it. The default is None.
+        loader : callable, optional
+            Function which opens a filepath and returns an ABF-like object,
+            such as patchanalysis.mappedabf.MappedABF for recordings too large
+            to load in full. The default is pyabf.ABF.
+
+        Returns
+        -------
+        resultsFrame : pd.DataFrame
+            One row per loaded recording and one column per measure, in the
+            order of filepathsDF regardless of which worker finished first.
+        errors : list
+            Error messages for recordings or measures that could not be
+            processed, in the order of filepathsDF.
+
+        """
+        recordings = self._recordings(filepathsDF, report, workers,
+                                      max_inflight, cache, loader)
         errors = []
-        resultsFrame = pd.DataFrame(
-            columns=[measure['name'] for measure in self.measures])
-        resultsFrame = resultsFrame.astype(
+        accumulator = ResultsAccumulator(
             {measure['name']: measure['dtype'] for measure in self.measures})
-        for recordingID, filepath in filepathsDF['Filepath'].items():
-            if report:
-                print(f'Opening file at {filepath}')
-            try:
-                abffile = pyabf.ABF(filepath)
-            except ValueError:
-                errors.append(f'{filepath} does not exist or cannot be loaded')
-            else:
-                for measure in self.measures:
-                    name = measure['name']
+        for recordingID, row, recording_errors in recordings:
+            if row:
+                accumulator.add(recordingID, row)
+            errors += recording_errors
+        return accumulator.frame(), errors
+
+    def stream(self, filepathsDF, sink, report=False, workers: int = None,
+               max_inflight: int = None, cache: ResultCache = None, loader=None,
+               resume: bool = True) -> list:
+        """
+        Apply every measure of the analysis to each recording in filepathsDF,
+        writing each recording's row to sink as soon as it is complete rather
+        than collecting a DataFrame in memory.
+
+        Parameters
+        ----------
+        filepathsDF : pd.DataFrame
+            Dataframe with a 'Filepath' column, indexed by recording ID.
+        sink : patchanalysis.sinks.ResultsSink
+            Destination for the results, such as a CSVSink, SQLiteSink or
+            ParquetSink. It is closed when processing finishes.
+        resume : bool, optional
+            If True, recordings whose ID is already present in the sink are
+            skipped, so a partially completed batch can be continued. The
+            default is True.
+
+        The remaining parameters are as described for process.
+
+        Returns
+        -------
+        errors : list
+            Error messages for recordings or measures that could not be
+            processed. Recordings which could not be loaded are not written
+            to the sink and are retried when resuming.
+
+        """
+        errors = []
+        with sink:
+            existing = sink.start([measure['name'] for measure in self.measures])
+            if resume and existing:
+                filepathsDF = filepathsDF[~filepathsDF.index.astype(str).isin(existing)]
+            for recordingID, row, recording_errors in self._recordings(
+                    filepathsDF, report, workers, max_inflight, cache, loader):
+                if row:
+                    sink.write(recordingID, row)
+                errors += recording_errors
+        return errors
+
+    def _recordings(self, filepathsDF, report, workers, max_inflight, cache, loader):
+        """
+        Yields the recordingID, row and errors of each recording in the order
+        of filepathsDF, processed serially or on a process pool.
+        """
+        if workers is not None and workers > 1:
+            context = self._pool_context(cache, loader)
+            if context is not None:
+                return self._process_parallel(filepathsDF, report, workers, max_inflight,
+                                              cache, loader, context)
+            warnings.warn('The analysis cannot be sent to worker processes on this platform, '
+                          'as its measures cannot be pickled. Processing recordings serially.')
+        return (self._process_recording(recordingID, filepath, report, cache, loader)
+                for recordingID, filepath in filepathsDF['Filepath'].items())
+
+    def _process_recording(self, recordingID, filepath, report=False, cache=None, loader=None):
+        """
+        Open a single recording and apply every measure to it. Returns the
+        recordingID, a dict of measure name to result and a list of errors.
+        """
+        if cache is not None:
+            cached = cache.get(filepath, self.fingerprint)
+            if cached is not None:
+                return recordingID, *cached
+        errors = []
+        row = {}
+        if report:
+            print(f'Opening file at {filepath}')
+        try:
+            abffile = (pyabf.ABF if loader is None else loader)(filepath)
+        except ValueError:
+            errors.append(f'{filepath} does not exist or cannot be loaded')
+        else:
+            # Measures built on withinEachSweep or acrossSweepMatrix share a
+            # single pass over the sweeps, the rest are handed the whole abffile.
+            traversable = [measure for measure in self.measures
+                           if hasattr(measure['unbinned_function'], 'sweepattrs')]
+            traversed = dict(zip(
+                [measure['name'] for measure in traversable],
+                traverseSweeps(abffile, [measure['unbinned_function']
+                                         for measure in traversable])))
+            for measure in self.measures:
+                name = measure['name']
+                try:
+                    if name in traversed:
+                        if isinstance(traversed[name], InvalidRecordingError):
+                            raise traversed[name]
+                        row[name] = binresults(traversed[name],
+                                               measure['binsize'],
+                                               measure['binfunction'])
+                    else:
+                        row[name] = measure['function'](abffile)
+                except InvalidRecordingError as error:
+                    errors.append(f'Recording is invalid for measure {
+                                  name}: {error}')
+                except NoResultError:
+                    row[name] = np.nan
+            if cache is not None:
+                cache.put(filepath, self.fingerprint, row, errors)
+        return recordingID, row, errors
+
+    def _pool_context(self, cache=None, loader=None):
+        """
+        Internal utility method choosing how worker processes are started.
+        Measures are closures and cannot be pickled, so the analysis is handed
+        to the workers by forking wherever the platform allows it. Elsewhere,
+        such as on Windows, workers are spawned and the analysis, cache and
+        loader must be pickled; None is returned if they cannot be.
+        """
+        if 'fork' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('fork')
+        try:
+            pickle.dumps((self, cache, loader))
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return None
+        return multiprocessing.get_context()
+
+    def _process_parallel(self, filepathsDF, report, workers: int, max_inflight: int = None,
+                          cache=None, loader=None, context=None):
+        """
+        Fan recordings out to a process pool, keeping at most max_inflight
+        recordings submitted at once. Yields per-recording results in the
+        order of filepathsDF.
+        """
+        if max_inflight is None:
+            max_inflight = 2 * workers
+        max_inflight = max(max_inflight, workers)
+
+        recordings = enumerate(filepathsDF['Filepath'].items())
+        finished = {}
+        next_position = 0
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=context,
+                                 initializer=_init_pool_worker,
+                                 initargs=(self,)) as pool:
+            inflight = {}
+            exhausted = False
+            while inflight or not exhausted:
+                while not exhausted and len(inflight) + len(finished) < max_inflight:
                     try:
-                        resultsFrame.at[recordingID,
-                                        name] = measure['function'](abffile)
-                    except InvalidRecordingError as error:
-                        errors.append(f'Recording is invalid for measure {
-                                      name}: {error}')
-                    except NoResultError:
-                        resultsFrame.at[recordingID, name] = np.nan
-        return resultsFrame, errors
+                        position, (recordingID, filepath) = next(recordings)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        future = pool.submit(_pool_process_recording,
+                                             recordingID, filepath, report, cache, loader)
+                        inflight[future] = position
+                if not inflight:
+                    break
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished[inflight.pop(future)] = future.result()
+                # Release results as soon as every earlier recording is done
+                while next_position in finished:
+                    yield finished.pop(next_position)
+                    next_position += 1
+
+
+_pool_analysis = None
+
+
+def _init_pool_worker(analysis):
+    """Store the analysis in a worker process for _pool_process_recording."""
+    global _pool_analysis
+    _pool_analysis = analysis
+
+
+def _pool_process_recording(recordingID, filepath, report=False, cache=None, loader=None):
+    return _pool_analysis._process_recording(recordingID, filepath, report, cache, loader)
+
+
+class ResultsAccumulator:
+    def __init__(self, dtypes: dict):
+        """
+        Collect per-recording results column by column and build a DataFrame
+        from them once, rather than writing to a DataFrame cell by cell.
+
+        Parameters
+        ----------
+        dtypes : dict
+            Measure name to dtype for every column, in column order.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.dtypes = dtypes
+        self.index = []
+        self.columns = {name: [] for name in dtypes}
+
+    def add(self, recordingID, row: dict):
+        """Append one recording's row. Measures missing from row become NaN."""
+        self.index.append(recordingID)
+        for name, column in self.columns.items():
+            column.append(row.get(name, np.nan))
+
+    def frame(self) -> pd.DataFrame:
+        """Build the DataFrame of all rows added so far"""
+        return pd.DataFrame({name: self._column(self.columns[name], dtype)
+                             for name, dtype in self.dtypes.items()},
+                            index=pd.Index(self.index),
+                            columns=list(self.dtypes))
+
+    @staticmethod
+    def _column(values: list, dtype):
+        """Internal utility method converting a column buffer to an array"""
+        if all(np.ndim(value) == 0 for value in values):
+            try:
+                return np.array(values, dtype=dtype)
+            except (TypeError, ValueError):
+                pass
+        # Unbinned measures give a list per recording, kept as objects
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
 
 
 def makebinnedfunction(func, binsize: int, binfunction) -> list:
@@ -99,19 +359,26 @@ def makebinnedfunction(func, binsize: int, binfunction) -> list:
     """
     if binsize is None:
         return func
-    if binsize == 0:
-        return lambda abffile: binfunction(func(abffile))
+    return lambda abffile: binresults(func(abffile), binsize, binfunction)
+
 
-    def binnedfunction(abffile):
-        results = func(abffile)
-        results_binned = []
-        while len(results) >= binsize:
-            results_binned.append(binfunction(
-                results[:binsize]
-            ))
-            del results[:binsize]
-        return results_binned
-    return binnedfunction
+def binresults(results: list, binsize: int, binfunction):
+    """
+    Seperates a list of results into bins and applies binfunction to each bin,
+    as described for makebinnedfunction. A binsize of None returns results
+    unchanged.
+    """
+    if binsize is None:
+        return results
+    if binsize == 0:
+        return binfunction(results)
+    results_binned = []
+    while len(results) >= binsize:
+        results_binned.append(binfunction(
+            results[:binsize]
+        ))
+        del results[:binsize]
+    return results_binned
 
 
 type Measure_Tuple = tuple[str, str]
@@ -123,7 +390,15 @@ class Derived_Measures:
         self.measures = []
         self.name = name
 
-    def add_measure(self, measure_inputs: list, func, name: str, dtype=np.float64):
+    def add_measure(self, measure_inputs: list, func, name: str, dtype=np.float64,
+                    vectorized: bool = False):
+        """
+        Add a measure derived from the measures in measure_inputs. func is
+        given one row of those measures at a time, or if vectorized is True,
+        a DataFrame holding every row of them at once, in which case it must
+        return one value per row. Functions which only index their input by
+        Measure_Tuple and use arithmetic work either way.
+        """
         if name in [measure['name'] for measure in self.measures]:
             raise WorkerAttemptedDestructiveOverwrite(
                 f'{name} already exists as a measure')
@@ -139,19 +414,27 @@ class Derived_Measures:
         self.measures.append({'name': name,
                               'measure_inputs': measure_inputs,
                               'function': func,
-                              'dtype': dtype
+                              'dtype': dtype,
+                              'vectorized': vectorized
                               })
 
     def process(self, resultsFrame):
-        derived_measures_frame = pd.DataFrame(
-            columns=[measure['name'] for measure in self.measures])
-        derived_measures_frame = derived_measures_frame.astype(
-            {measure['name']: measure['dtype'] for measure in self.measures})
-        derived_measures_frame.columns = pd.MultiIndex.from_tuples([(self.name, measure['name']) for measure in self.measures])
+        derived_columns = {}
         for measure in self.measures:
             name = measure['name']
             measure_inputs = measure['measure_inputs']
             func = measure['function']
             resultsFrame_inputs_only: pd.DataFrame = resultsFrame[measure_inputs]
-            derived_measures_frame[(self.name,name)] = resultsFrame_inputs_only.apply(func, axis=1)
+            if measure['vectorized']:
+                column = pd.Series(func(resultsFrame_inputs_only), index=resultsFrame.index)
+            else:
+                column = resultsFrame_inputs_only.apply(func, axis=1)
+            # Measures giving values which do not fit dtype, such as lists, keep their own
+            try:
+                column = column.astype(measure['dtype'])
+            except (TypeError, ValueError):
+                pass
+            derived_columns[(self.name, name)] = column
+        derived_measures_frame = pd.DataFrame(derived_columns, index=resultsFrame.index)
+        derived_measures_frame.columns = pd.MultiIndex.from_tuples([(self.name, measure['name']) for measure in self.measures])
         return derived_measures_frame